@@ -21,5 +21,6 @@ sleep 30
 # Ship params.json to bucket
 aws s3 cp params.json s3://$bucket/ --quiet
 
-# Kick off and deploy Scheduled Lambda for Continuous Crawling
-sam deploy --template-file l4m-redshift-continuous-crawl.yaml --stack-name custom-rs-connector-crawl --capabilities CAPABILITY_IAM --s3-bucket $1 --parameter-overrides "InputBucketName=$bucket RedshiftCluster=$2 RedshiftSecret=$3"
+# Kick off and deploy Scheduled Lambda for Continuous Crawling, once per detector interval
+crawl_schedule=$(python -c "import json, sys; sys.path.append('lambdas/shared/python'); from schedule import get_crawl_schedule; print(get_crawl_schedule(json.load(open('params.json'))['detector_frequency']))")
+sam deploy --template-file l4m-redshift-continuous-crawl.yaml --stack-name custom-rs-connector-crawl --capabilities CAPABILITY_IAM --s3-bucket $1 --parameter-overrides "InputBucketName=$bucket RedshiftCluster=$2 RedshiftSecret=$3 CrawlSchedule=\"$crawl_schedule\""
@@ -1,45 +1,128 @@
-import boto3
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+from clients import get_client, call_with_backoff
+from actions import check_detectors
+from unload import get_unload_options, apply_file_format
+from metrics import instrument_handler, timed
 
+MAX_WORKERS = 4
 
-def lambda_handler(event, context):
-    # Logging
-    print(event)
-    # Connect to L4M:
-    l4m = boto3.client("lookoutmetrics")
+
+def get_detector_specs(event):
+    """
+    Expands the optional "detectors" list of the event into one spec per detector. Every entry inherits the
+    top level params and only needs to override what differs, e.g. detector_name and metrics_set.
+    Without a "detectors" list the event itself describes the only detector.
+    """
+    defaults = {key: value for key, value in event.items() if key != 'detectors'}
+    return [dict(defaults, **spec) for spec in event.get('detectors') or [{}]]
+
+
+def list_all(operation, result_key, **kwargs):
+    items = []
+    while True:
+        response = call_with_backoff(operation, **kwargs)
+        items += response[result_key]
+        if not response.get('NextToken'):
+            return items
+        kwargs['NextToken'] = response['NextToken']
+
+
+def get_existing_detectors(l4m):
+    return {detector['AnomalyDetectorName']: detector['AnomalyDetectorArn']
+            for detector in list_all(l4m.list_anomaly_detectors, 'AnomalyDetectorSummaryList')}
+
+
+def get_existing_metric_sets(l4m, anomaly_detector_arn):
+    return {metric_set['MetricSetName']: metric_set['MetricSetArn']
+            for metric_set in list_all(l4m.list_metric_sets, 'MetricSetSummaryList',
+                                       AnomalyDetectorArn=anomaly_detector_arn)}
+
+
+def provision_detector(l4m, spec, existing_detectors):
+    """
+    Creates, or reuses when one with the same name already exists, the detector and metric set of a spec and
+    activates the detector.
+    :return: the detector and metric set ARNs
+    """
+    detector_name = spec['detector_name'] + "-" + spec['database_type']
+    metric_set_name = spec.get('metric_set_name', detector_name + '-metric-set-1')
 
     # Create Detector
-    response = l4m.create_anomaly_detector(
-        AnomalyDetectorName=event['detector_name'] + "-" + event['database_type'],
-        AnomalyDetectorDescription=event['detector_description'],
-        AnomalyDetectorConfig={
-            "AnomalyDetectorFrequency": event['detector_frequency'],
-        },
-    )
+    anomaly_detector_arn = existing_detectors.get(detector_name)
+    if anomaly_detector_arn is None:
+        try:
+            response = call_with_backoff(
+                l4m.create_anomaly_detector,
+                AnomalyDetectorName=detector_name,
+                AnomalyDetectorDescription=spec['detector_description'],
+                AnomalyDetectorConfig={
+                    "AnomalyDetectorFrequency": spec['detector_frequency'],
+                },
+            )
+            anomaly_detector_arn = response["AnomalyDetectorArn"]
+        except ClientError as e:
+            # Created by a concurrent or earlier run since the detectors were listed
+            if e.response['Error']['Code'] != 'ConflictException':
+                raise
+            anomaly_detector_arn = get_existing_detectors(l4m)[detector_name]
+
+    # Create Metric Set
+    anomaly_detector_metric_set_arn = get_existing_metric_sets(l4m, anomaly_detector_arn).get(metric_set_name)
+    if anomaly_detector_metric_set_arn is None:
+        params = {
+            "AnomalyDetectorArn": anomaly_detector_arn,
+            "MetricSetName": metric_set_name,
+            "MetricList": spec['metrics_set'],
+
+            "DimensionList": spec['dimension_list'],
+
+            "TimestampColumn": spec['timestamp_column'],
 
-    anomaly_detector_arn = response["AnomalyDetectorArn"]
+            "Offset": spec['offset'], # seconds the detector will wait before attempting to read latest data per current time and detection frequency below
+            "MetricSetFrequency": spec['detector_frequency'],
 
-    params = {
-        "AnomalyDetectorArn": anomaly_detector_arn,
-        "MetricSetName":  event['detector_name'] + "-" + event['database_type'] + '-metric-set-1',
-        "MetricList": event['metrics_set'],
+            # The crawls write compressed files when unload_options asks for it, so the descriptor has to follow
+            "MetricSource": apply_file_format(spec['metric_source'], get_unload_options(spec))
+        }
+        anomaly_detector_metric_set_arn = call_with_backoff(l4m.create_metric_set, **params)["MetricSetArn"]
 
-        "DimensionList": event['dimension_list'],
+    # Activate the Detector, a detector that is already activating or active is left alone
+    try:
+        call_with_backoff(l4m.activate_anomaly_detector, AnomalyDetectorArn=anomaly_detector_arn)
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConflictException':
+            raise
 
-        "TimestampColumn": event['timestamp_column'],
+    return {'anomaly_detector_arn': anomaly_detector_arn,
+            'anomaly_detector_metric_set_arn': anomaly_detector_metric_set_arn}
 
-        "Offset": event['offset'], # seconds the detector will wait before attempting to read latest data per current time and detection frequency below
-        "MetricSetFrequency": event['detector_frequency'],
 
-        "MetricSource": event['metric_source']
-    }
+@instrument_handler('create-and-activate-detector')
+def lambda_handler(event, context):
+    # Logging
+    print(event)
+    # Connect to L4M:
+    l4m = get_client("lookoutmetrics")
+
+    specs = get_detector_specs(event)
+    existing_detectors = get_existing_detectors(l4m)
+    with ThreadPoolExecutor(max_workers=event.get('provisioning_concurrency', MAX_WORKERS)) as executor, \
+            timed('Provisioning'):
+        results = list(executor.map(lambda spec: provision_detector(l4m, spec, existing_detectors), specs))
 
-    anomaly_detector_metric_set_arn = l4m.create_metric_set(**params)
+    return_dict = dict(results[0]) if len(results) == 1 else {}
+    return_dict['detectors'] = {spec['detector_name'] + "-" + spec['database_type']: result
+                                for spec, result in zip(specs, results)}
+    return return_dict
 
-    # Activate the Detector
-    l4m.activate_anomaly_detector(AnomalyDetectorArn=anomaly_detector_arn)
 
-    # actions.take_action(status['status'])
-    return_dict = {}
-    return_dict['anomaly_detector_arn'] = anomaly_detector_arn
-    return_dict['anomaly_detector_metric_set_arn'] = anomaly_detector_metric_set_arn
-    return return_dict
\ No newline at end of file
+@instrument_handler('check-detector-status')
+def status_handler(event, context):
+    """
+    Checks every detector returned by lambda_handler in one pass. Raises ResourcePending while any of them is
+    still activating, which the state machine retries with backoff, and ResourceFailed if any of them failed.
+    """
+    l4m = get_client("lookoutmetrics")
+    anomaly_detector_arns = [result['anomaly_detector_arn'] for result in event['detectors'].values()]
+    return check_detectors(l4m, anomaly_detector_arns)
@@ -1,18 +1,140 @@
 import os
-from boto3 import client
+import gzip
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from clients import get_client, call_with_backoff
+from parameters import get_params
+from metrics import instrument_handler, timed, add_count
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Every anomaly group is exported as one gzip JSON lines object under this prefix of ExportBucketName, keyed by
+# the day it started on and its Id. An alert for a group that grew rewrites the same object, so concurrent and
+# repeated alerts never produce duplicates.
+EXPORT_PREFIX = os.getenv('ExportPrefix', 'anomalies/')
+PARAMS_FILE = 'params.json'
+DEFAULT_ALERT_THRESHOLD = 1
+MAX_WORKERS = 8
+MAX_RESULTS = 100
+
 
 def get_message(event):
+    # The state machine only invokes Notify from its Fail state
     if 'statesError' in event.keys():
         return 'Internal error: {}'.format(event['statesError'])
-    if 'serviceError' in event.keys():
-        return 'Service error: {}'.format(event['statesError'])
-    return 'Your Personalize Endpoint is ready!'
+    return 'Lookout for Metrics detector setup failed: {}'.format(event.get('serviceError', 'unknown error'))
+
+
+def parse_time(value):
+    return datetime.strptime(value[:19].replace(' ', 'T'), '%Y-%m-%dT%H:%M:%S')
+
+
+def list_time_series(l4m, anomaly_detector_arn, anomaly_group_id, metric_name):
+    """
+    Pages through the time series of one metric of an anomaly group.
+    :return: list of compact time series records
+    """
+    request = {'AnomalyDetectorArn': anomaly_detector_arn, 'AnomalyGroupId': anomaly_group_id,
+               'MetricName': metric_name, 'MaxResults': MAX_RESULTS}
+    time_series = []
+    while True:
+        response = call_with_backoff(l4m.list_anomaly_group_time_series, **request)
+        for series in response.get('TimeSeriesList', []):
+            time_series.append({'metric': metric_name,
+                                'dimensions': {dimension['DimensionName']: dimension['DimensionValue']
+                                               for dimension in series.get('DimensionList', [])},
+                                'timestamps': response.get('TimestampList', []),
+                                'values': series.get('MetricValueList', [])})
+        if not response.get('NextToken'):
+            return time_series
+        request['NextToken'] = response['NextToken']
+
+
+def fetch_anomaly_group(l4m, anomaly_detector_arn, anomaly_group_id):
+    """
+    Reads an anomaly group and, from a bounded thread pool, the time series of every metric it impacts.
+    :return: one compact record of the group
+    """
+    with timed('FetchAnomalyGroup'):
+        group = call_with_backoff(l4m.get_anomaly_group, AnomalyGroupId=anomaly_group_id,
+                                  AnomalyDetectorArn=anomaly_detector_arn)['AnomalyGroup']
+        impacts = group.get('MetricLevelImpactList', [])
+        with ThreadPoolExecutor(max_workers=max(1, min(MAX_WORKERS, len(impacts)))) as executor:
+            time_series = list(executor.map(
+                lambda impact: list_time_series(l4m, anomaly_detector_arn, anomaly_group_id, impact['MetricName']),
+                impacts))
+    return {'anomaly_detector_arn': anomaly_detector_arn,
+            'anomaly_group_id': anomaly_group_id,
+            'start_time': group.get('StartTime'),
+            'end_time': group.get('EndTime'),
+            'score': group.get('AnomalyGroupScore'),
+            'primary_metric': group.get('PrimaryMetricName'),
+            'metric_impacts': [{'metric': impact['MetricName'], 'time_series': impact.get('NumTimeSeries'),
+                                'contributions': impact.get('ContributionMatrix', {})}
+                               for impact in impacts],
+            'time_series': [series for metric_series in time_series for series in metric_series]}
+
+
+def get_export_key(record):
+    return "{}date={}/{}.jsonl.gz".format(EXPORT_PREFIX, parse_time(record['start_time']).strftime('%Y-%m-%d'),
+                                          record['anomaly_group_id'])
 
+
+def write_record(s3, bucket, record):
+    """
+    Writes the record of an anomaly group to its own object, replacing an earlier export of the same group.
+    :return: the key written
+    """
+    key = get_export_key(record)
+    body = gzip.compress((json.dumps(record, separators=(',', ':')) + "\n").encode('utf-8'))
+    with timed('ExportWrite'):
+        s3.put_object(Bucket=bucket, Key=key, Body=body, ContentEncoding='gzip', ContentType='application/x-ndjson')
+    return key
+
+
+def export_anomaly_group(event, context):
+    """
+    Exports the anomaly group of a Lookout for Metrics alert to S3, if its score reaches the alert_threshold of
+    params.json. Every alert exports only its own group, so an alert storm fans out over concurrent invocations
+    that never touch the same object, and a repeated alert rewrites the object with the latest state.
+
+    :param event: the Lookout for Metrics alert
+    :param context: The context in which the function is called.
+    :return: whether the group was exported and its key
+    """
+    bucket = os.environ['ExportBucketName']
+    anomaly_group_id = event['anomalyGroupId']
+    threshold = get_params(bucket, PARAMS_FILE).get('alert_threshold', DEFAULT_ALERT_THRESHOLD)
+    score = event.get('anomalyGroupScore')
+    if score is not None and score < threshold:
+        logger.info("Anomaly group {} scored {}, below the alert_threshold of {}".format(
+            anomaly_group_id, score, threshold))
+        add_count('AnomalyGroupsSkipped')
+        return {'exported': False, 'anomaly_group_id': anomaly_group_id}
+
+    record = fetch_anomaly_group(get_client('lookoutmetrics'), event['anomalyDetectorArn'], anomaly_group_id)
+    key = write_record(get_client('s3'), bucket, record)
+    add_count('AnomalyGroupsExported')
+    add_count('TimeSeriesExported', len(record['time_series']))
+    logger.info("Exported anomaly group {} with {} time series to {}".format(
+        anomaly_group_id, len(record['time_series']), key))
+    return {'exported': True, 'anomaly_group_id': anomaly_group_id, 'key': key}
+
+
+@instrument_handler('notify')
 def lambda_handler(event, context):
+    # Lookout for Metrics alerts carry their anomaly group, failures of the state machine do not
+    if 'anomalyGroupId' in event:
+        return export_anomaly_group(event, context)
+
     print("NOTIFY FUNCTION LOG --------")
-    
+
     print(event)
-    
+    print(get_message(event))
+
     print("NOTIFY FUNCTION LOG END --------")
-    
-    return True
\ No newline at end of file
+
+    return True
@@ -2,5 +2,5 @@ select ecommerce.ts as timestamp, ecommerce.views, ecommerce.revenue, platform.n
 from ecommerce, platform, marketplace
 where ecommerce.platform = platform.id
 	and ecommerce.marketplace = marketplace.id
-    and ecommerce.ts < DATEADD(hour, 0, getdate())
-    and ecommerce.ts > DATEADD(hour, -1, getdate())
\ No newline at end of file
+    and ecommerce.ts >= '{start_time}'
+    and ecommerce.ts < '{end_time}'
\ No newline at end of file
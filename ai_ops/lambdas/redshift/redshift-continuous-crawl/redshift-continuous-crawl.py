@@ -8,31 +8,82 @@ After that, the state machine will progress to the next steps.
 """
 
 import logging
-import boto3
-import botocore.session as s
 from botocore.exceptions import ClientError
-from datetime import datetime
+from datetime import datetime, timedelta
+from clients import get_client, submit_with_secret
+from parameters import get_params
+from statements import wait_for_statements
+from unload import get_unload_options, build_unload_query, build_aggregate_query
+from metrics import instrument_handler, timed, add_count
+from schedule import get_interval, get_partition_format, get_first_end, get_pending_windows, list_partitions, \
+    advance_watermark, floor_time
+from concurrent.futures import ThreadPoolExecutor
 import json
-import time
 import os
-import base64
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# High-water marks of the last exported interval per query, kept in the input bucket next to params.json
+STATE_KEY = 'crawl_state.json'
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+MAX_CATCHUP_INTERVALS = 24
+DEFAULT_QUERY_NAME = 'continuous'
+MAX_WORKERS = 8
 
-def get_and_parse_params():
+
+def get_queries(params):
+    """
+    Reads the named queries to crawl from the optional continuous_queries list of params.json, e.g.
+    [{"name": "orders", "query_file": "orders.sql", "destination": "s3://bucket/orders/live/"},
+     {"name": "payments", "query": "select ...", "destination": "s3://bucket/payments/live/"}]
+    Without the list the packaged query.sql is crawled into s3_path_continuous_root.
+    :return: list of dicts with name, query template and destination
+    """
+    queries = []
+    for definition in params.get('continuous_queries') or [{'name': DEFAULT_QUERY_NAME}]:
+        query = definition.get('query')
+        if query is None:
+            with open(definition.get('query_file', 'query.sql'), "r") as sql_file:
+                query = sql_file.read()
+        queries.append({'name': definition['name'],
+                        'query': query.strip('\n'),
+                        'destination': definition.get('destination', params.get('s3_path_continuous_root'))})
+    return queries
+
+
+def get_watermarks(bucket):
+    """
+    Reads the high-water marks committed by the previous run.
+    :return: dict of query name -> end of the last exported interval as a datetime
+    """
+    s3 = get_client('s3')
+    try:
+        with timed('StateRead'):
+            state = json.loads(s3.get_object(Bucket=bucket, Key=STATE_KEY)['Body'].read().decode('utf-8'))
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'NoSuchKey':
+            return {}
+        raise
+    watermarks = state.get('watermarks', {})
+    # State written before named queries existed only tracked the packaged query
+    if 'watermark' in state:
+        watermarks.setdefault(DEFAULT_QUERY_NAME, state['watermark'])
+    return {name: datetime.strptime(watermark, TIMESTAMP_FORMAT) for name, watermark in watermarks.items()}
+
+
+def commit_watermarks(bucket, watermarks):
     """
-    uses the environment variable of an s3 bucket to fetch a file loaded with everything else needed from the step
-    functions configuration.
-    :return: params as JSON object
+    Persists the end of the last successfully exported interval of every query.
     """
-    s3 = boto3.client('s3')
-    s3.download_file(os.getenv('InputBucketName'), 'params.json', '/tmp/params.json')
-    with open("/tmp/params.json") as file:
-        return json.load(file)
+    s3 = get_client('s3')
+    with timed('StateWrite'):
+        s3.put_object(Bucket=bucket, Key=STATE_KEY,
+                  Body=json.dumps({'watermarks': {name: watermark.strftime(TIMESTAMP_FORMAT)
+                                                  for name, watermark in watermarks.items()}}))
 
 
+@instrument_handler('redshift-continuous-crawl')
 def lambda_handler(event, context):
     """
     Accepts the params passed to it via the statemachine call param event.
@@ -45,107 +96,110 @@ def lambda_handler(event, context):
     # Configure logging
     logger.info('Event: %s', event)
     # Load the Params File from S3 For latest configuration
-    params = get_and_parse_params()
-    # Load the secret name and connect to the service
-    secret_name = params['secret_name']
-    session = boto3.session.Session()
-    region = session.region_name
+    params = get_params(os.getenv('InputBucketName'), 'params.json')
+    return crawl(params, context)
 
-    client = session.client(
-        service_name='secretsmanager',
-        region_name=region
-    )
 
-    # Validate the secret name
-    try:
-        get_secret_value_response = client.get_secret_value(
-            SecretId=secret_name
-        )
-        secret_arn = get_secret_value_response['ARN']
+def crawl(params, context):
+    """
+    Unloads the pending intervals of every query to S3 and moves their watermarks along. Intervals follow
+    detector_frequency, so each one lands in the partition Lookout for Metrics reads for it. The partitions that
+    already exist are listed first and skipped; the rest are submitted in parallel batches of up to
+    continuous_batch_size statements and waited on together. An interval that fails or is still running is
+    picked up again by the next run.
 
-    except ClientError as e:
-        print("Error retrieving secret. Error: " + e.response['Error']['Message'])
-    # Perform this if there are no exceptions with the earlier block of code
-    else:
-        # Depending on whether the secret is a string or binary, one of these fields will be populated.
-        if 'SecretString' in get_secret_value_response:
-            secret = get_secret_value_response['SecretString']
-        else:
-            secret = base64.b64decode(get_secret_value_response['SecretBinary'])
-    # Create a dictionary object of the secrets values for use later
-    secrets = json.loads(secret)
-    cluster_id = secrets['dbClusterIdentifier']
-    db = secrets['db']
-
-    # Build Redshift Connection:
-    session = boto3.session.Session()
-    bc_session = s.get_session()
-    region = session.region_name
-    session = boto3.Session(
-        botocore_session=bc_session,
-        region_name=region,
-    )
-    client_redshift = session.client("redshift-data")
-    isSynchronous = True
-
-    # Read file for connection query:
-    with open("query.sql", "r") as sql_file:
-        query_input = sql_file.read().strip('\n')
-        iam_role = params['metric_source']['S3SourceConfig']['RoleArn']
-        bucket_str = params['s3_path_continuous_root']
-        #Now for a continuous detector we need a timestamp pathing format, we recommend: {{yyyyMMdd}}/{{HHmm}} so add that to the string
-        date_str = datetime.today().strftime('%Y%m%d/%H00/')
-        bucket_str += date_str
-        print(bucket_str)
-        # build the query that will perform the content from the file, and stream it to S3.
-        query = "unload ('" + query_input + "') to '" + bucket_str + "' iam_role '" + iam_role + "' header CSV;"
-        # execute the query
-        client_redshift.execute_statement(Database=db, SecretArn=secret_arn, Sql=query,
-                                          ClusterIdentifier=cluster_id)
-        MAX_WAIT_CYCLES = 15
-        attempts = 0
-        # Calling Redshift Data API with executeStatement()
-        res = client_redshift.execute_statement(Database=db, SecretArn=secret_arn, Sql=query,
-                                          ClusterIdentifier=cluster_id)
-        query_id = res["Id"]
-        desc = client_redshift.describe_statement(Id=query_id)
-        query_status = desc["Status"]
-        logger.info(
-            "Query status: {} .... for query-->{}".format(query_status, query))
-        done = False
-
-        # Wait until query is finished or max cycles limit has been reached.
-        while not done and isSynchronous and attempts < MAX_WAIT_CYCLES:
-            attempts += 1
-            time.sleep(60)
-            desc = client_redshift.describe_statement(Id=query_id)
-            query_status = desc["Status"]
-
-            if query_status == "FAILED":
-                raise Exception('SQL query failed:' +
-                                query_id + ": " + desc["Error"])
-
-            elif query_status == "FINISHED":
-                logger.info("query status is: {} for query id: {}".format(
-                    query_status, query_id))
-                done = True
-                # print result if there is a result (typically from Select statement)
-                if desc['HasResultSet']:
-                    response = client_redshift.get_statement_result(
-                        Id=query_id)
-                    logger.info(
-                        "Printing response of query --> {}".format(response['Records']))
-            else:
-                logger.info(
-                    "Current working... query status is: {} ".format(query_status))
-
-        # Timeout Precaution
-        if done == False and attempts >= MAX_WAIT_CYCLES and isSynchronous:
-            logger.info(
-                "Limit for MAX_WAIT_CYCLES has been reached before the query was able to finish. We have exited out of the while-loop. You may increase the limit accordingly. \n")
-            raise Exception("query status is: {} for query id: {}".format(
-                query_status, query_id))
-
-
-        response = {'result': ("Current working... query status is: {} ".format(query_status))}
-        return response
\ No newline at end of file
+    :param params: the parsed params.json
+    :param context: The context in which the function is called.
+    :return: the status of every query
+    """
+    # The secret is cached between warm invocations and only read again when a submission is rejected
+    secret_name = params['secret_name']
+    client_redshift = get_client("redshift-data")
+    s3 = get_client('s3')
+
+    iam_role = params['metric_source']['S3SourceConfig']['RoleArn']
+    unload_options = get_unload_options(params)
+    queries = get_queries(params)
+    interval = get_interval(params['detector_frequency'])
+    partition_format = get_partition_format(params['detector_frequency'])
+    # Lookout for Metrics reads an interval offset seconds after it ends, it should be in S3 by then
+    offset = params.get('offset', 0)
+
+    # Work out which intervals have not been exported yet
+    bucket_name = os.getenv('InputBucketName')
+    watermarks = get_watermarks(bucket_name)
+    now = datetime.utcnow()
+    latest = floor_time(now, interval)
+    max_intervals = params.get('max_catchup_intervals', MAX_CATCHUP_INTERVALS)
+    backfill = params.get('continuous_backfill', False)
+
+    # One listing per destination, starting at the oldest interval any of its queries could still need
+    present = {}
+    with timed('PartitionListing'):
+        for destination in {query['destination'] for query in queries}:
+            first_end = min(get_first_end(watermarks.get(query['name']), now, interval, max_intervals, backfill)
+                            for query in queries if query['destination'] == destination)
+            present[destination] = list_partitions(s3, destination, partition_format, first_end - interval)
+
+    pending = [(query, start, end) for query in queries
+               for start, end in get_pending_windows(watermarks.get(query['name']), now, interval, max_intervals,
+                                                     present[query['destination']], backfill)]
+    # Oldest intervals first, so the detector's next read is served before older gaps
+    pending.sort(key=lambda task: task[2])
+    report = {query['name']: {'status': 'UP_TO_DATE', 'intervals': []} for query in queries}
+    logger.info("Watermarks: {}, pending intervals: {}".format(watermarks, len(pending)))
+
+    def submit(task):
+        query, start, end = task
+        query_input = query['query'].replace('{start_time}', start.strftime(TIMESTAMP_FORMAT)) \
+            .replace('{end_time}', end.strftime(TIMESTAMP_FORMAT))
+        if unload_options.get('aggregate'):
+            # Export one row per dimension combination and detector interval instead of the raw rows
+            query_input = build_aggregate_query(query_input, params)
+        # The partition follows the TemplatedPathList of the detector, e.g. {{yyyyMMdd}}/{{HHmm}}
+        bucket_str = query['destination'] + end.strftime(partition_format)
+        # build the query that will perform the content from the file, and stream it to S3. A retried interval
+        # overwrites its own partition.
+        sql = build_unload_query(query_input, bucket_str, iam_role, unload_options)
+        statement_name = "{}-{}-{}".format(params['detector_name'], query['name'], end.strftime('%Y%m%d%H%M'))
+        return submit_with_secret(client_redshift, sql, statement_name, secret_name)
+
+    exported = {query['name']: set(present[query['destination']]) for query in queries}
+    batch_size = params.get('continuous_batch_size', MAX_WORKERS)
+    with ThreadPoolExecutor(max_workers=min(batch_size, MAX_WORKERS)) as executor:
+        while pending:
+            batch, pending = pending[:batch_size], pending[batch_size:]
+            statement_ids = list(executor.map(submit, batch))
+            descriptions = wait_for_statements(client_redshift, statement_ids, context)
+
+            for (query, start, end), statement_id in zip(batch, statement_ids):
+                name = query['name']
+                desc = descriptions[statement_id]
+                if report[name]['status'] in ('UP_TO_DATE', 'FINISHED'):
+                    report[name]['status'] = desc["Status"]
+                if desc["Status"] == "FINISHED":
+                    exported[name].add(end)
+                    report[name]['intervals'].append(end.strftime(TIMESTAMP_FORMAT))
+                    add_count('IntervalsExported')
+                    if datetime.utcnow() > end + timedelta(seconds=offset):
+                        # Exported after the detector read this interval
+                        add_count('IntervalsLate')
+                elif desc["Status"] in ("FAILED", "ABORTED"):
+                    logger.info("Query {} failed for the interval ending {}: {}".format(name, end, desc.get("Error")))
+                    report[name]['error'] = desc.get("Error", desc["Status"])
+                else:
+                    # Still running: the next run finds it in flight under the same name and picks it up from there
+                    logger.info("Query {} is still running as {}".format(name, statement_id))
+
+            # Only move a watermark over intervals that are safely in S3
+            for query in queries:
+                watermark = advance_watermark(watermarks.get(query['name']), exported[query['name']], interval, latest)
+                if watermark:
+                    watermarks[query['name']] = watermark
+            commit_watermarks(bucket_name, watermarks)
+            if any(desc["Status"] not in ("FINISHED", "FAILED", "ABORTED") for desc in descriptions.values()):
+                break
+
+    response = {'result': {name: entry['status'] for name, entry in report.items()},
+                'queries': report}
+    return response
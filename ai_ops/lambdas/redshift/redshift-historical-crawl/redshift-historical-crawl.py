@@ -8,18 +8,115 @@ After that, the state machine will progress to the next steps.
 """
 
 import logging
-import boto3
-import botocore.session as s
-from botocore.exceptions import ClientError
-import json
+from datetime import datetime
+from dateutil.relativedelta import relativedelta
+from actions import ResourceFailed
+from statements import wait_for_statement, get_statement_status, get_remaining_seconds, backoff_delays
+from unload import get_unload_options, build_unload_query, build_aggregate_query
+from clients import get_client, submit_with_secret
+from results import get_single_value
+from metrics import instrument_handler, timed, add_count
+from schedule import get_interval, floor_time
+import re
 import time
-import os
-import base64
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+HISTORICAL_WINDOW = 'P1M'
+MAX_IN_FLIGHT = 4
+MAX_WINDOW_ATTEMPTS = 3
 
+
+def parse_window(window):
+    """
+    Converts an ISO 8601 style duration such as P1M, P7D or PT6H into a relativedelta.
+    """
+    match = re.fullmatch(r'P(?:(\d+)M)?(?:(\d+)D)?(?:T(\d+)H)?', window)
+    if not match or not any(match.groups()):
+        raise ValueError('Unsupported historical_window: ' + window)
+    months, days, hours = (int(group or 0) for group in match.groups())
+    return relativedelta(months=months, days=days, hours=hours)
+
+
+def build_windows(start, end, window):
+    """
+    Splits [start, end) into consecutive windows, each tracked with its own statement Id and attempt count.
+    """
+    step = parse_window(window)
+    windows = []
+    while start < end:
+        windows.append({'start': start.strftime(TIMESTAMP_FORMAT),
+                        'end': min(start + step, end).strftime(TIMESTAMP_FORMAT),
+                        'id': None,
+                        'status': 'PENDING',
+                        'attempts': 0})
+        start += step
+    return windows
+
+
+def render_query(query_template, start, end):
+    return query_template.replace('{start_time}', start).replace('{end_time}', end)
+
+
+def get_history_start(client_redshift, secret_name, query_template, end, statement_name):
+    """
+    Looks up the oldest timestamp returned by the crawl query.
+    :return: the oldest timestamp floored to the hour, or None if there is no data
+    """
+    query = 'select min("timestamp") from (' + render_query(query_template, '1900-01-01 00:00:00', end) + \
+        ') as source'
+    query_id = submit_with_secret(client_redshift, query, statement_name, secret_name)
+    wait_for_statement(client_redshift, query_id)
+    oldest = get_single_value(client_redshift, query_id)
+    if oldest is None:
+        return None
+    return datetime.fromisoformat(oldest[:19]).replace(minute=0, second=0, microsecond=0)
+
+
+def unload_windows(client_redshift, secret_name, windows, build_query, statement_prefix, max_in_flight,
+                   context=None, wait=True):
+    """
+    Runs one UNLOAD per window, keeping at most max_in_flight statements running at once.
+    Failed windows are resubmitted on their own up to MAX_WINDOW_ATTEMPTS times.
+    With wait=False, or when the Lambda is about to time out, it returns after submitting instead of
+    waiting; the windows keep their statement Ids so a later invocation can carry on polling them.
+    :return: True once every window has finished
+    """
+    delays = backoff_delays()
+    while True:
+        running = [w for w in windows if w['status'] == 'SUBMITTED']
+        for window in running:
+            try:
+                if get_statement_status(client_redshift, window['id'])["Status"] == "FINISHED":
+                    window['status'] = 'FINISHED'
+            except ResourceFailed as e:
+                logger.info("Window {} - {} failed: {}".format(window['start'], window['end'], e))
+                if window['attempts'] >= MAX_WINDOW_ATTEMPTS:
+                    raise
+                window['status'] = 'PENDING'
+        running = [w for w in running if w['status'] == 'SUBMITTED']
+
+        for window in [w for w in windows if w['status'] == 'PENDING'][:max_in_flight - len(running)]:
+            statement_name = "{}-{}".format(statement_prefix, window['start'].replace(' ', 'T'))
+            window['id'] = submit_with_secret(client_redshift, build_query(window), statement_name, secret_name)
+            window['status'] = 'SUBMITTED'
+            window['attempts'] += 1
+            running.append(window)
+
+        if not running:
+            return True
+        remaining = get_remaining_seconds(context)
+        if not wait or (remaining is not None and remaining <= 0):
+            logger.info("Returning {} running windows to the state machine".format(len(running)))
+            return False
+        delay = next(delays)
+        with timed('StatementWait'):
+            time.sleep(delay if remaining is None else min(delay, remaining))
+
+
+@instrument_handler('redshift-historical-crawl')
 def lambda_handler(event, context):
     """
     Accepts the params passed to it via the statemachine call param event.
@@ -35,105 +132,58 @@ def lambda_handler(event, context):
     # Configure Logging
     logger.info('Event: %s', event)
 
-    # Load the secret name and connect to the service
+    return crawl(event, context)
+
+
+def crawl(event, context):
+    """
+    Submits and tracks the UNLOAD of every historical window.
+
+    :param event: The event dict that contains the parameters sent when the function is invoked.
+    :param context: The context in which the function is called.
+    :return: The result of the specified action.
+    """
+    # The secret is cached between warm invocations and only read again when a submission is rejected
     secret_name = event['secret_name']
-    session = boto3.session.Session()
-    region = session.region_name
-
-    client = session.client(
-        service_name='secretsmanager',
-        region_name=region
-    )
-
-    # Validate the secret name
-    try:
-        get_secret_value_response = client.get_secret_value(
-            SecretId=secret_name
-        )
-        secret_arn = get_secret_value_response['ARN']
-
-    except ClientError as e:
-        print("Error retrieving secret. Error: " + e.response['Error']['Message'])
-
-    # Perform this if there are no exceptions with the earlier block of code
-    else:
-        # Depending on whether the secret is a string or binary, one of these fields will be populated.
-        if 'SecretString' in get_secret_value_response:
-            secret = get_secret_value_response['SecretString']
-        else:
-            secret = base64.b64decode(get_secret_value_response['SecretBinary'])
-    # Create a dictionary object of the secrets values for use later
-    secrets = json.loads(secret)
-    cluster_id = secrets['dbClusterIdentifier']
-    db = secrets['db']
-
-    # Build Redshift Connection:
-    session = boto3.session.Session()
-    bc_session = s.get_session()
-    region = session.region_name
-    session = boto3.Session(
-        botocore_session=bc_session,
-        region_name=region,
-    )
-    client_redshift = session.client("redshift-data")
-    isSynchronous = True
+    client_redshift = get_client("redshift-data")
 
     # Read file for connection query:
     with open("query.sql", "r") as sql_file:
-        query_input = sql_file.read().strip('\n')
-        iam_role = event['metric_source']['S3SourceConfig']['RoleArn']
-        bucket_str = event['metric_source']['S3SourceConfig']['HistoricalDataPathList'][0]
-        # build the query that will perform the content from the file, and stream it to S3.
-        query = "unload ('" + query_input + "') to '" + bucket_str + "' iam_role '" + iam_role + "' header CSV;"
-        # execute the query
-        client_redshift.execute_statement(Database=db, SecretArn=secret_arn, Sql=query,
-                                          ClusterIdentifier=cluster_id)
-        # Technically you can ignore all of this from here on out, it just logs information. However you may want to remove it
-        # if your state function is failing to execute.
-        MAX_WAIT_CYCLES = 15
-        attempts = 0
-        # Calling Redshift Data API with executeStatement()
-        res = client_redshift.execute_statement(Database=db, SecretArn=secret_arn, Sql=query,
-                                          ClusterIdentifier=cluster_id)
-        query_id = res["Id"]
-        desc = client_redshift.describe_statement(Id=query_id)
-        query_status = desc["Status"]
-        logger.info(
-            "Query status: {} .... for query-->{}".format(query_status, query))
-        done = False
-
-        # Wait until query is finished or max cycles limit has been reached.
-        while not done and isSynchronous and attempts < MAX_WAIT_CYCLES:
-            attempts += 1
-            time.sleep(60)
-            desc = client_redshift.describe_statement(Id=query_id)
-            query_status = desc["Status"]
-
-            if query_status == "FAILED":
-                raise Exception('SQL query failed:' +
-                                query_id + ": " + desc["Error"])
-
-            elif query_status == "FINISHED":
-                logger.info("query status is: {} for query id: {}".format(
-                    query_status, query_id))
-                done = True
-                # print result if there is a result (typically from Select statement)
-                if desc['HasResultSet']:
-                    response = client_redshift.get_statement_result(
-                        Id=query_id)
-                    logger.info(
-                        "Printing response of query --> {}".format(response['Records']))
-            else:
-                logger.info(
-                    "Current working... query status is: {} ".format(query_status))
-
-        # Timeout Precaution
-        if done == False and attempts >= MAX_WAIT_CYCLES and isSynchronous:
-            logger.info(
-                "Limit for MAX_WAIT_CYCLES has been reached before the query was able to finish. We have exited out of the while-loop. You may increase the limit accordingly. \n")
-            raise Exception("query status is: {} for query id: {}".format(
-                query_status, query_id))
-
-
-        response = {'result': ("Current working... query status is: {} ".format(query_status))}
-        return response
\ No newline at end of file
+        query_template = sql_file.read().strip('\n')
+    iam_role = event['metric_source']['S3SourceConfig']['RoleArn']
+    bucket_str = event['metric_source']['S3SourceConfig']['HistoricalDataPathList'][0]
+    unload_options = get_unload_options(event)
+
+    statement_prefix = event['detector_name'] + '-historical'
+
+    # Resume the windows of a previous invocation, or split the history into windows
+    windows = event.get('crawl', {}).get('windows')
+    if windows is None:
+        # The latest interval is left to the continuous crawl, whose first window it is
+        interval = get_interval(event['detector_frequency'])
+        end = floor_time(datetime.utcnow(), interval) - interval
+        start = get_history_start(client_redshift, secret_name, query_template, end.strftime(TIMESTAMP_FORMAT),
+                                  statement_prefix + '-start')
+        windows = build_windows(start, end, event.get('historical_window', HISTORICAL_WINDOW)) if start else []
+
+    def build_query(window):
+        # Every window unloads under its own file name prefix inside the historical data path, so windows
+        # neither collide nor need separate folders. A retried window overwrites its own files.
+        query_input = render_query(query_template, window['start'], window['end'])
+        if unload_options.get('aggregate'):
+            # Export one row per dimension combination and detector interval instead of the raw rows
+            query_input = build_aggregate_query(query_input, event)
+        prefix = bucket_str + datetime.strptime(window['start'], TIMESTAMP_FORMAT).strftime('%Y%m%d%H') + '_'
+        return build_unload_query(query_input, prefix, iam_role, unload_options)
+
+    complete = unload_windows(client_redshift, secret_name, windows, build_query, statement_prefix,
+                              event.get('historical_max_in_flight', MAX_IN_FLIGHT), context,
+                              wait=not event.get('historical_async', False))
+
+    finished = len([w for w in windows if w['status'] == 'FINISHED'])
+    add_count('WindowsFinished', finished)
+    add_count('WindowsPending', len(windows) - finished)
+    response = {'result': "Finished {} of {} windows".format(finished, len(windows)),
+                'complete': complete,
+                'windows': windows}
+    return response
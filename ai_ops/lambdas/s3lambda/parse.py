@@ -1,33 +1,62 @@
 import os
-from json import loads, dumps
+import re
+import hashlib
+from json import dumps
 from datetime import datetime
-from boto3 import client
+from botocore.exceptions import ClientError
+from clients import get_client
+from parameters import get_params
+from metrics import instrument_handler
 
-STEP_FUNCTIONS_CLI = client('stepfunctions')
+STEP_FUNCTIONS_CLI = get_client('stepfunctions')
 
 
-def get_params(bucket_name, key_name):
-    params = loads(
-        client('s3').get_object(Bucket=bucket_name,
-                                Key=key_name)['Body'].read().decode('utf-8')
-    )
-    return params
+def group_records_by_bucket(records):
+    buckets = {}
+    for record in records:
+        buckets.setdefault(record['s3']['bucket']['name'], []).append(record)
+    return buckets
 
 
-def lambda_handler(event, context):
-    bucket_name = event['Records'][0]['s3']['bucket']['name']
-    return dumps(
-        STEP_FUNCTIONS_CLI.start_execution(
+def get_execution_name(bucket_name, records):
+    """
+    Derives the execution name from the uploads themselves, so the same batch always maps to the same name
+    and two different batches never share one, even within the same second.
+    """
+    uploads = sorted("{}:{}".format(record['s3']['object']['key'], record['s3']['object'].get('sequencer', ''))
+                     for record in records)
+    digest = hashlib.sha256("\n".join([bucket_name] + uploads).encode('utf-8')).hexdigest()
+    # Execution names are limited to 80 characters from a restricted set
+    return re.sub(r'[^A-Za-z0-9_-]', '-', bucket_name)[:47] + '-' + digest[:32]
+
+
+def start_execution(bucket_name, records):
+    event_time = max(datetime.strptime(record['eventTime'][:19], "%Y-%m-%dT%H:%M:%S") for record in records)
+    try:
+        return STEP_FUNCTIONS_CLI.start_execution(
             stateMachineArn=os.environ['STEP_FUNCTIONS_ARN'],
-            name=datetime.now().strftime("%Y_%m_%d_%H_%M_%S"),
+            name=get_execution_name(bucket_name, records),
             input=dumps(
                 {
                     'bucket': bucket_name,
-                    'currentDate': datetime.now().strftime("%Y_%m_%d_%H_%M_%S"),
+                    'currentDate': event_time.strftime("%Y_%m_%d_%H_%M_%S"),
                     'params':
                         get_params(bucket_name, os.environ['PARAMS_FILE'])
                 }
             )
-        ),
+        )
+    except ClientError as e:
+        # A redelivered batch was already started under the same name
+        if e.response['Error']['Code'] != 'ExecutionAlreadyExists':
+            raise
+        return {'name': get_execution_name(bucket_name, records), 'alreadyStarted': True}
+
+
+@instrument_handler('s3-trigger')
+def lambda_handler(event, context):
+    # Every record of the batch is handled, uploads to the same bucket share one execution
+    return dumps(
+        [start_execution(bucket_name, records)
+         for bucket_name, records in group_records_by_bucket(event['Records']).items()],
         default=str
-    )
\ No newline at end of file
+    )
@@ -1,3 +1,8 @@
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+from datetime import datetime, timedelta, timezone
+
+
 class ResourcePending(Exception):
     pass
 
@@ -6,15 +11,77 @@ class ResourceFailed(Exception):
     pass
 
 
+# Lookout for Metrics detector states. INACTIVE is pending because a detector still reports it for a moment
+# after activate_anomaly_detector was called, but only for INACTIVE_GRACE after its last modification.
+PENDING_STATES = {'INACTIVE', 'ACTIVATING', 'BACK_TEST_ACTIVATING'}
+INACTIVE_GRACE = timedelta(minutes=5)
+READY_STATES = {'ACTIVE', 'LEARNING', 'BACK_TEST_ACTIVE', 'BACK_TEST_COMPLETE'}
+DELETE_PENDING_STATES = {'DELETING'}
+MAX_WORKERS = 8
+THROTTLING_ERROR_CODES = {'ThrottlingException', 'TooManyRequestsException', 'Throttling', 'RequestLimitExceeded'}
+
+
 def take_action(status):
-    if status in {'CREATE PENDING', 'CREATE IN_PROGRESS'}:
+    if status in PENDING_STATES:
         raise ResourcePending
-    if status != 'ACTIVE':
+    if status not in READY_STATES:
         raise ResourceFailed
     return True
 
 
 def take_action_delete(status):
-    if status in {'DELETE PENDING', 'DELETE IN_PROGRESS'}:
+    if status in DELETE_PENDING_STATES:
         raise ResourcePending
     raise ResourceFailed
+
+
+def is_stuck_inactive(description, now=None):
+    """
+    True for a detector that is still INACTIVE INACTIVE_GRACE after it was last modified, i.e. after activation.
+    """
+    modified = description.get('LastModificationTime') or description.get('CreationTime')
+    if description['Status'] != 'INACTIVE' or not isinstance(modified, datetime):
+        return False
+    if modified.tzinfo is None:
+        modified = modified.replace(tzinfo=timezone.utc)
+    return (now or datetime.now(timezone.utc)) - modified > INACTIVE_GRACE
+
+
+def check_detectors(l4m, anomaly_detector_arns):
+    """
+    Describes every detector at once and applies take_action to the whole batch, so a state machine Retry on
+    ResourcePending can poll them without the Lambda sleeping. Failures are reported before pending ones.
+    :return: dict of detector ARN -> status once all of them are ready
+    """
+    def describe(arn):
+        try:
+            return l4m.describe_anomaly_detector(AnomalyDetectorArn=arn)
+        except ClientError as e:
+            if e.response['Error']['Code'] not in THROTTLING_ERROR_CODES:
+                raise
+            # A throttled check is retried like a pending detector by the Retry of the state machine
+            return {'Status': 'THROTTLED'}
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        descriptions = list(executor.map(describe, anomaly_detector_arns))
+    failed = []
+    pending = []
+    for arn, description in zip(anomaly_detector_arns, descriptions):
+        if description['Status'] == 'THROTTLED':
+            pending.append(arn)
+            continue
+        if is_stuck_inactive(description):
+            failed.append("{}: still INACTIVE {:.0f} minutes after activation".format(
+                arn, INACTIVE_GRACE.total_seconds() / 60))
+            continue
+        try:
+            take_action(description['Status'])
+        except ResourcePending:
+            pending.append(arn)
+        except ResourceFailed:
+            failed.append("{}: {} {}".format(arn, description['Status'], description.get('FailureReason', '')))
+    if failed:
+        raise ResourceFailed('; '.join(failed))
+    if pending:
+        raise ResourcePending('{} of {} detectors still activating'.format(len(pending), len(descriptions)))
+    return {arn: description['Status'] for arn, description in zip(anomaly_detector_arns, descriptions)}
@@ -0,0 +1,103 @@
+import base64
+import json
+import threading
+import time
+import boto3
+from botocore.exceptions import ClientError
+from actions import THROTTLING_ERROR_CODES
+from statements import backoff_delays, submit_statement
+from metrics import timed, add_count, instrument_client
+
+# Secrets are re-read after this many seconds, or straight away when a call using them is rejected
+SECRET_TTL_SECONDS = 5 * 60
+AUTH_ERROR_CODES = {'AccessDeniedException', 'UnrecognizedClientException', 'InvalidSignatureException',
+                    'ExpiredTokenException'}
+MAX_THROTTLE_RETRIES = 8
+
+# Created once per Lambda container and reused by warm invocations
+_lock = threading.Lock()
+_session = None
+_clients = {}
+_secrets = {}
+
+
+def get_session():
+    global _session
+    with _lock:
+        if _session is None:
+            _session = boto3.session.Session()
+        return _session
+
+
+def get_client(service_name):
+    """
+    Returns the container wide client for service_name, creating it on first use.
+    """
+    session = get_session()
+    with _lock:
+        if service_name not in _clients:
+            with timed('ClientCreation'):
+                _clients[service_name] = instrument_client(
+                    session.client(service_name=service_name, region_name=session.region_name))
+        return _clients[service_name]
+
+
+def get_secret(secret_name, refresh=False):
+    """
+    Fetches and decodes a Secrets Manager secret, caching it for SECRET_TTL_SECONDS.
+    :return: tuple of the secret ARN and the secret values as a dict
+    """
+    with _lock:
+        cached = _secrets.get(secret_name)
+    if cached and not refresh and time.monotonic() - cached[0] < SECRET_TTL_SECONDS:
+        return cached[1]
+
+    with timed('SecretFetch'):
+        get_secret_value_response = get_client('secretsmanager').get_secret_value(SecretId=secret_name)
+    # Depending on whether the secret is a string or binary, one of these fields will be populated.
+    if 'SecretString' in get_secret_value_response:
+        secret = get_secret_value_response['SecretString']
+    else:
+        secret = base64.b64decode(get_secret_value_response['SecretBinary'])
+    value = (get_secret_value_response['ARN'], json.loads(secret))
+    with _lock:
+        _secrets[secret_name] = (time.monotonic(), value)
+    return value
+
+
+def with_secret(secret_name, action):
+    """
+    Calls action with the cached secret. If AWS rejects the call for authentication reasons, e.g. after the
+    secret was rotated or recreated, the secret is fetched again and the action retried once.
+    """
+    try:
+        return action(get_secret(secret_name))
+    except ClientError as e:
+        if e.response['Error']['Code'] not in AUTH_ERROR_CODES:
+            raise
+    return action(get_secret(secret_name, refresh=True))
+
+
+def submit_with_secret(client_redshift, sql, statement_name, secret_name):
+    """
+    Submits sql with the Redshift credentials of secret_name. Only the submission uses the secret, so only it is
+    retried with the secret fetched again when Redshift rejects it.
+    :return: the statement Id
+    """
+    return with_secret(secret_name, lambda secret: submit_statement(
+        client_redshift, sql, statement_name, secret[1]['db'], secret[0], secret[1]['dbClusterIdentifier']))
+
+
+def call_with_backoff(operation, **kwargs):
+    """
+    Calls a client operation, retrying with exponential backoff while the service throttles it.
+    """
+    for attempt, delay in enumerate(backoff_delays()):
+        try:
+            return operation(**kwargs)
+        except ClientError as e:
+            if e.response['Error']['Code'] not in THROTTLING_ERROR_CODES or attempt >= MAX_THROTTLE_RETRIES:
+                raise
+        add_count('ThrottleRetries')
+        with timed('ThrottleWait'):
+            time.sleep(delay)
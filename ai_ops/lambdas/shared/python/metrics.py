@@ -0,0 +1,164 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from functools import wraps
+from botocore import xform_name
+
+# Metrics are written as CloudWatch Embedded Metric Format log lines, CloudWatch turns them into metrics
+NAMESPACE = os.getenv('METRICS_NAMESPACE', 'L4MCustomConnector')
+
+# The first invocation of a container is a cold start, later ones reuse the clients and caches
+_cold_start = True
+_lock = threading.Lock()
+_current = None
+
+
+def _print_line(line):
+    print(line, flush=True)
+
+
+_sink = _print_line
+
+
+def set_sink(sink):
+    """
+    Replaces where EMF lines go (stdout by default), e.g. set_sink(lines.append) to capture them locally.
+    """
+    global _sink
+    _sink = sink or _print_line
+
+
+class Invocation:
+    """
+    Phase timings and counters of one handler invocation. Phases that run in several threads at once are summed.
+    """
+
+    def __init__(self, handler_name, cold_start):
+        self.handler_name = handler_name
+        self.cold_start = cold_start
+        self.started = time.monotonic()
+        self.phases = {}
+        self.counts = {'ApiCalls': 0, 'ApiRetries': 0}
+        self.operations = {}
+
+    def add_phase(self, name, seconds):
+        with _lock:
+            self.phases[name] = self.phases.get(name, 0) + seconds
+
+    def add_count(self, name, value):
+        with _lock:
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    def add_api_call(self, operation, retries):
+        with _lock:
+            self.counts['ApiCalls'] += 1
+            self.counts['ApiRetries'] += retries
+            self.operations[operation] = self.operations.get(operation, 0) + 1
+
+    def to_emf(self, error=None):
+        values = {'Duration': round((time.monotonic() - self.started) * 1000, 3), 'ColdStart': int(self.cold_start)}
+        units = {'Duration': 'Milliseconds', 'ColdStart': 'Count'}
+        for name, seconds in self.phases.items():
+            values[name + 'Time'] = round(seconds * 1000, 3)
+            units[name + 'Time'] = 'Milliseconds'
+        for name, value in self.counts.items():
+            values[name] = value
+            units.setdefault(name, 'Count')
+        record = {
+            '_aws': {
+                'Timestamp': int(datetime.utcnow().timestamp() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': NAMESPACE,
+                    'Dimensions': [['Handler']],
+                    'Metrics': [{'Name': name, 'Unit': units[name]} for name in values],
+                }],
+            },
+            'Handler': self.handler_name,
+            'ApiCallsByOperation': self.operations,
+        }
+        if error is not None:
+            record['Error'] = error
+        record.update(values)
+        return json.dumps(record)
+
+
+def instrument_handler(handler_name):
+    """
+    Decorates a Lambda handler so every invocation emits one EMF line with its duration, cold start flag,
+    phase timings and API call counts, also when the handler raises.
+    """
+    def decorator(handler):
+        @wraps(handler)
+        def wrapper(event, context):
+            global _cold_start, _current
+            with _lock:
+                invocation = _current = Invocation(handler_name, _cold_start)
+                _cold_start = False
+            error = None
+            try:
+                return handler(event, context)
+            except Exception as e:
+                error = type(e).__name__
+                raise
+            finally:
+                with _lock:
+                    _current = None
+                _sink(invocation.to_emf(error))
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def timed(phase):
+    """
+    Times a named phase of the current invocation, e.g. with timed('SecretFetch'): ...
+    Outside an instrumented handler this does nothing.
+    """
+    invocation = _current
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        if invocation is not None:
+            invocation.add_phase(phase, time.monotonic() - started)
+
+
+def add_count(name, value=1):
+    invocation = _current
+    if invocation is not None:
+        invocation.add_count(name, value)
+
+
+def record_api_call(operation, retries=0):
+    invocation = _current
+    if invocation is not None:
+        invocation.add_api_call(operation, retries)
+
+
+def record_statement(desc):
+    """
+    Splits the time of a finished Redshift Data API statement into queue and execution time, from its
+    describe_statement response.
+    """
+    invocation = _current
+    if invocation is None or 'Duration' not in desc or 'CreatedAt' not in desc or 'UpdatedAt' not in desc:
+        return
+    execution = max(desc['Duration'], 0) / 1e9
+    total = (desc['UpdatedAt'] - desc['CreatedAt']).total_seconds()
+    invocation.add_phase('StatementExecution', execution)
+    invocation.add_phase('StatementQueue', max(total - execution, 0))
+
+
+def instrument_client(client):
+    """
+    Counts every call a boto3 client makes, and the retries botocore made for it, towards the current invocation.
+    """
+    def after_call(model, parsed, **kwargs):
+        retries = parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0) if isinstance(parsed, dict) else 0
+        record_api_call(client.meta.service_model.service_name + '.' + xform_name(model.name), retries)
+
+    client.meta.events.register('after-call', after_call)
+    return client
@@ -1,10 +1,72 @@
-from json import loads
-from boto3 import client
+import os
+import threading
+from copy import deepcopy
+from json import loads, dumps
+from botocore.exceptions import ClientError
+from clients import get_client
+from metrics import timed
+
+REQUIRED_PARAMS = ['database_type', 'detector_name', 'detector_frequency', 'timestamp_column', 'dimension_list',
+                   'metrics_set', 'metric_source', 'offset', 'secret_name']
+CACHE_DIR = '/tmp'
+
+# (bucket, key) -> (ETag, parsed params), shared by warm invocations
+_lock = threading.Lock()
+_cache = {}
+
+
+def validate_params(params):
+    missing = [name for name in REQUIRED_PARAMS if name not in params]
+    if missing:
+        raise ValueError('params file is missing: ' + ', '.join(missing))
+    if 'S3SourceConfig' not in params['metric_source']:
+        raise ValueError('params file is missing: metric_source.S3SourceConfig')
+
+
+def _cache_path(bucket_name, key_name):
+    return os.path.join(CACHE_DIR, '{}-{}.cache.json'.format(bucket_name, key_name.replace('/', '_')))
+
+
+def _read_cache(bucket_name, key_name):
+    cached = _cache.get((bucket_name, key_name))
+    if cached is None:
+        try:
+            with open(_cache_path(bucket_name, key_name)) as file:
+                entry = loads(file.read())
+            cached = (entry['etag'], entry['params'])
+        except (OSError, ValueError, KeyError):
+            return None
+    return cached
+
+
+def _write_cache(bucket_name, key_name, etag, params):
+    _cache[(bucket_name, key_name)] = (etag, params)
+    try:
+        with open(_cache_path(bucket_name, key_name), 'w') as file:
+            file.write(dumps({'etag': etag, 'params': params}))
+    except OSError:
+        pass
 
 
 def get_params(bucket_name, key_name):
-    S3 = client('s3')
-    return loads(
-        client('s3').get_object(Bucket=bucket_name,
-                                Key=key_name)['Body'].read().decode('utf-8')
-    )
+    """
+    Loads a params file from S3, keeping the parsed copy in memory and in /tmp. Later calls only revalidate
+    it with a conditional GET on the ETag, and the file is validated once per version.
+    :return: params as JSON object
+    """
+    with _lock, timed('ParamsLoad'):
+        cached = _read_cache(bucket_name, key_name)
+        request = {'Bucket': bucket_name, 'Key': key_name}
+        if cached:
+            request['IfNoneMatch'] = cached[0]
+        try:
+            response = get_client('s3').get_object(**request)
+        except ClientError as e:
+            if cached and e.response['Error']['Code'] in ('304', 'NotModified'):
+                _cache[(bucket_name, key_name)] = cached
+                return deepcopy(cached[1])
+            raise
+        params = loads(response['Body'].read().decode('utf-8'))
+        validate_params(params)
+        _write_cache(bucket_name, key_name, response['ETag'], params)
+        return deepcopy(params)
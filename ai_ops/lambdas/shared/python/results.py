@@ -0,0 +1,63 @@
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+FIELD_KEYS = ('booleanValue', 'longValue', 'doubleValue', 'stringValue', 'blobValue')
+
+
+def field_value(field):
+    """
+    Converts one Data API field, e.g. {'longValue': 1} or {'isNull': True}, to a python value.
+    """
+    if field.get('isNull'):
+        return None
+    for key in FIELD_KEYS:
+        if key in field:
+            return field[key]
+    return None
+
+
+def iter_pages(client_redshift, statement_id):
+    """
+    Yields get_statement_result pages one at a time, following NextToken, so only one page is held in memory.
+    """
+    request = {'Id': statement_id}
+    while True:
+        page = client_redshift.get_statement_result(**request)
+        yield page
+        if not page.get('NextToken'):
+            return
+        request['NextToken'] = page['NextToken']
+
+
+def iter_rows(client_redshift, statement_id):
+    """
+    Yields every row of a statement's result as a tuple of python values.
+    """
+    for page in iter_pages(client_redshift, statement_id):
+        for record in page['Records']:
+            yield tuple(field_value(field) for field in record)
+
+
+def iter_column_batches(client_redshift, statement_id):
+    """
+    Yields one dict of column name -> values per result page. Values are NumPy arrays when NumPy is
+    available in the runtime, lists otherwise.
+    """
+    names = None
+    for page in iter_pages(client_redshift, statement_id):
+        if names is None:
+            names = [column['name'] for column in page['ColumnMetadata']]
+        columns = [[field_value(field) for field in fields] for fields in zip(*page['Records'])] or \
+            [[] for _ in names]
+        yield {name: np.array(values) if np is not None else values for name, values in zip(names, columns)}
+
+
+def get_single_value(client_redshift, statement_id):
+    """
+    Returns the first column of the first row, or None if the result is empty.
+    """
+    for row in iter_rows(client_redshift, statement_id):
+        return row[0]
+    return None
@@ -0,0 +1,119 @@
+import re
+from datetime import datetime, timedelta
+from unload import get_frequency_minutes
+
+# Lookout for Metrics fills the {{...}} placeholders of TemplatedPathList with the interval timestamp
+DAILY_TEMPLATE = ('{{yyyyMMdd}}', '%Y%m%d/')
+INTRADAY_TEMPLATE = ('{{yyyyMMdd}}/{{HHmm}}', '%Y%m%d/%H%M/')
+ALIGNMENT_ORIGIN = datetime(2000, 1, 1)
+
+
+def get_interval(detector_frequency):
+    return timedelta(minutes=get_frequency_minutes(detector_frequency))
+
+
+def get_path_template(detector_frequency):
+    """
+    The TemplatedPathList suffix matching the partitions the continuous crawl writes for this frequency.
+    """
+    return (DAILY_TEMPLATE if get_frequency_minutes(detector_frequency) == 24 * 60 else INTRADAY_TEMPLATE)[0]
+
+
+def get_partition_format(detector_frequency):
+    """
+    strftime format of the partition an interval is written to, relative to the continuous root.
+    """
+    return (DAILY_TEMPLATE if get_frequency_minutes(detector_frequency) == 24 * 60 else INTRADAY_TEMPLATE)[1]
+
+
+def get_crawl_schedule(detector_frequency):
+    """
+    The EventBridge schedule expression (CrawlSchedule) that runs the continuous crawl once per detector interval,
+    on the same clock-aligned boundaries as floor_time().
+    """
+    minutes = get_frequency_minutes(detector_frequency)
+    if minutes < 60:
+        return 'cron(0/{} * * * ? *)'.format(minutes)
+    if minutes == 60:
+        return 'cron(0 * * * ? *)'
+    return 'cron(0 0 * * ? *)'
+
+
+def floor_time(moment, interval):
+    """
+    Floors moment to an interval boundary, boundaries are counted from midnight so they line up with the clock.
+    """
+    return moment - (moment - ALIGNMENT_ORIGIN) % interval
+
+
+def split_s3_path(s3_path):
+    match = re.match(r's3://([^/]+)/?(.*)', s3_path)
+    return match.group(1), match.group(2)
+
+
+def list_partitions(s3, destination, partition_format, start_after=None):
+    """
+    Finds the partitions under destination that already hold at least one object, with a single paginated
+    listing that starts after the partition of start_after.
+    :return: set of the interval ends (datetimes) of the partitions present
+    """
+    bucket, prefix = split_s3_path(destination)
+    depth = partition_format.count('/')
+    request = {'Bucket': bucket, 'Prefix': prefix}
+    if start_after is not None:
+        request['StartAfter'] = prefix + start_after.strftime(partition_format)
+    present = set()
+    for page in s3.get_paginator('list_objects_v2').paginate(**request):
+        for item in page.get('Contents', []):
+            parts = item['Key'][len(prefix):].split('/')
+            if len(parts) <= depth:
+                continue
+            try:
+                present.add(datetime.strptime('/'.join(parts[:depth]) + '/', partition_format))
+            except ValueError:
+                # Not a partition, e.g. files of another layout under the same root
+                continue
+    return present
+
+
+def get_first_end(watermark, now, interval, max_intervals, backfill=False):
+    """
+    The end of the oldest interval get_pending_windows considers, the partition listing can start there.
+    """
+    latest = floor_time(now, interval)
+    end = floor_time(watermark, interval) + interval if watermark else latest
+    if backfill:
+        end = min(end, latest - interval * (max_intervals - 1))
+    return end
+
+
+def get_pending_windows(watermark, now, interval, max_intervals, present=(), backfill=False):
+    """
+    Lists up to max_intervals [start, end) intervals to export, oldest first. An interval is due once it has
+    ended. Pending are the due intervals after the watermark (only the latest one without a watermark), and with
+    backfill also those of the last max_intervals intervals, but never an interval whose partition is present.
+    """
+    latest = floor_time(now, interval)
+    end = get_first_end(watermark, now, interval, max_intervals, backfill)
+    windows = []
+    while end <= latest and len(windows) < max_intervals:
+        if end not in present:
+            windows.append((end - interval, end))
+        end += interval
+    return windows
+
+
+def advance_watermark(watermark, exported, interval, latest):
+    """
+    Moves the watermark over every consecutive interval that has been exported.
+    :param exported: set of the interval ends that are in S3
+    """
+    if watermark is None:
+        # Partitions dated in the future, e.g. of a synthesized live tree, must not move the watermark ahead
+        due = [end for end in exported if end <= latest]
+        return max(due) if due else None
+    end = floor_time(watermark, interval) + interval
+    while end <= latest and end in exported:
+        watermark = end
+        end += interval
+    return watermark
@@ -0,0 +1,129 @@
+import logging
+import random
+import time
+from actions import ResourcePending, ResourceFailed
+from metrics import timed, record_statement
+
+logger = logging.getLogger()
+
+IN_FLIGHT_STATUSES = {'SUBMITTED', 'PICKED', 'STARTED'}
+INITIAL_DELAY = 0.5
+MAX_DELAY = 30
+BACKOFF_FACTOR = 2
+# Give up waiting when less Lambda time than this is left, so the handler can still return cleanly
+TIMEOUT_MARGIN_MS = 30 * 1000
+
+
+def find_in_flight(client_redshift, statement_name):
+    """
+    Looks for a statement with exactly this name that is still queued or running.
+    :return: the statement Id, or None
+    """
+    # StatementName is matched as a prefix, so compare the full name on the results.
+    paginator = client_redshift.get_paginator('list_statements')
+    for page in paginator.paginate(StatementName=statement_name, Status='ALL'):
+        for statement in page['Statements']:
+            if statement.get('StatementName') == statement_name and statement['Status'] in IN_FLIGHT_STATUSES:
+                return statement['Id']
+    return None
+
+
+def submit_statement(client_redshift, sql, statement_name, database, secret_arn, cluster_id):
+    """
+    Submits sql exactly once under statement_name. If a statement with the same name is already queued or
+    running, for example from a retried Lambda invocation for the same interval, its Id is returned instead
+    of starting the work a second time.
+    :return: the statement Id
+    """
+    with timed('StatementSubmit'):
+        statement_id = find_in_flight(client_redshift, statement_name)
+        if statement_id:
+            logger.info("Statement {} is already in flight as {}".format(statement_name, statement_id))
+            return statement_id
+        statement_id = client_redshift.execute_statement(Database=database, SecretArn=secret_arn, Sql=sql,
+                                                         ClusterIdentifier=cluster_id,
+                                                         StatementName=statement_name)["Id"]
+    logger.info("Submitted statement {} as {}".format(statement_name, statement_id))
+    return statement_id
+
+
+def backoff_delays(initial_delay=INITIAL_DELAY, max_delay=MAX_DELAY):
+    """
+    Yields exponentially growing sleep times, each jittered between half and all of the current delay.
+    """
+    delay = initial_delay
+    while True:
+        yield delay / 2 + random.uniform(0, delay / 2)
+        delay = min(delay * BACKOFF_FACTOR, max_delay)
+
+
+def get_statement_status(client_redshift, statement_id):
+    """
+    Checks a statement once without waiting.
+    :return: the describe_statement response
+    """
+    desc = client_redshift.describe_statement(Id=statement_id)
+    if desc["Status"] in ("FAILED", "ABORTED"):
+        raise ResourceFailed('SQL query failed:' + statement_id + ": " + desc.get("Error", desc["Status"]))
+    if desc["Status"] == "FINISHED":
+        record_statement(desc)
+    return desc
+
+
+def get_remaining_seconds(context=None, timeout=None):
+    """
+    Seconds left to wait, bounded by the Lambda context and/or an explicit timeout. None means no limit.
+    """
+    limits = []
+    if context is not None:
+        limits.append((context.get_remaining_time_in_millis() - TIMEOUT_MARGIN_MS) / 1000)
+    if timeout is not None:
+        limits.append(timeout)
+    return min(limits) if limits else None
+
+
+def wait_for_statement(client_redshift, statement_id, context=None, timeout=None):
+    """
+    Polls describe_statement with exponential backoff until the statement finishes. A short query is
+    picked up within a second, a long one is polled at most every MAX_DELAY seconds.
+    Raises ResourcePending if the Lambda is about to time out, or timeout seconds have passed, while the
+    statement is still running, and ResourceFailed if it fails.
+    :return: the final describe_statement response
+    """
+    started = time.monotonic()
+    for delay in backoff_delays():
+        desc = get_statement_status(client_redshift, statement_id)
+        if desc["Status"] == "FINISHED":
+            logger.info("query status is: {} for query id: {}".format(desc["Status"], statement_id))
+            return desc
+        remaining = get_remaining_seconds(context, None if timeout is None else timeout - (time.monotonic() - started))
+        if remaining is not None and remaining <= 0:
+            raise ResourcePending("query status is: {} for query id: {}".format(desc["Status"], statement_id))
+        with timed('StatementWait'):
+            time.sleep(delay if remaining is None else min(delay, remaining))
+
+
+def wait_for_statements(client_redshift, statement_ids, context=None, timeout=None):
+    """
+    Polls many statements together with one backoff schedule until each has finished, failed or been
+    aborted, or until the Lambda is about to time out. Individual failures do not raise.
+    :return: dict of statement Id -> last describe_statement response
+    """
+    started = time.monotonic()
+    descriptions = {}
+    running = list(statement_ids)
+    for delay in backoff_delays():
+        for statement_id in running:
+            descriptions[statement_id] = client_redshift.describe_statement(Id=statement_id)
+            if descriptions[statement_id]["Status"] == "FINISHED":
+                record_statement(descriptions[statement_id])
+        running = [statement_id for statement_id in running
+                   if descriptions[statement_id]["Status"] in IN_FLIGHT_STATUSES]
+        if not running:
+            return descriptions
+        remaining = get_remaining_seconds(context, None if timeout is None else timeout - (time.monotonic() - started))
+        if remaining is not None and remaining <= 0:
+            logger.info("{} statements are still running".format(len(running)))
+            return descriptions
+        with timed('StatementWait'):
+            time.sleep(delay if remaining is None else min(delay, remaining))
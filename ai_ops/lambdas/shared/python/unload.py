@@ -0,0 +1,81 @@
+from copy import deepcopy
+
+# Lookout for Metrics reads CSV files either uncompressed or gzipped
+SUPPORTED_COMPRESSION = {'NONE', 'GZIP'}
+
+
+def get_unload_options(params):
+    """
+    Reads the optional unload_options block of params.json, e.g.
+    {"compression": "GZIP", "parallel": true, "max_file_size": "256 MB", "aggregate": true}
+    """
+    options = dict(params.get('unload_options', {}))
+    options['compression'] = options.get('compression', 'NONE').upper()
+    if options['compression'] not in SUPPORTED_COMPRESSION:
+        raise ValueError('Unsupported unload compression: ' + options['compression'])
+    return options
+
+
+def build_unload_query(query_input, destination, iam_role, options):
+    """
+    Wraps a select statement in an UNLOAD to destination as CSV with a header row, compressed and split
+    according to the unload options. Existing files with the same prefix are overwritten.
+    """
+    query = "unload ('" + query_input.replace("'", "''") + "') to '" + destination + "' iam_role '" + iam_role + \
+            "' header CSV"
+    if options['compression'] == 'GZIP':
+        query += " gzip"
+    if 'parallel' in options:
+        query += " parallel " + ("on" if options['parallel'] else "off")
+    if 'max_file_size' in options:
+        query += " maxfilesize " + options['max_file_size']
+    return query + " allowoverwrite;"
+
+
+def apply_file_format(metric_source, options):
+    """
+    Returns a copy of the metric source whose FileFormatDescriptor matches the files the crawls write.
+    """
+    metric_source = deepcopy(metric_source)
+    descriptor = metric_source['S3SourceConfig']['FileFormatDescriptor'].setdefault('CsvFormatDescriptor', {})
+    descriptor['FileCompression'] = options['compression']
+    return metric_source
+
+
+# Detector frequencies supported by Lookout for Metrics, in minutes
+FREQUENCY_MINUTES = {'PT5M': 5, 'PT10M': 10, 'PT1H': 60, 'P1D': 24 * 60}
+AGGREGATION_FUNCTIONS = {'SUM': 'sum', 'AVG': 'avg'}
+
+
+def get_frequency_minutes(detector_frequency):
+    if detector_frequency not in FREQUENCY_MINUTES:
+        raise ValueError('Unsupported detector_frequency: ' + detector_frequency)
+    return FREQUENCY_MINUTES[detector_frequency]
+
+
+def truncate_timestamp(column, detector_frequency):
+    """
+    SQL expression that floors a timestamp column to the start of its detector interval.
+    """
+    minutes = get_frequency_minutes(detector_frequency)
+    if minutes == 60:
+        return "date_trunc('hour', " + column + ")"
+    if minutes == 24 * 60:
+        return "date_trunc('day', " + column + ")"
+    return "dateadd(minute, (datediff(minute, '2000-01-01', " + column + ") / " + str(minutes) + ") * " + \
+           str(minutes) + ", '2000-01-01')"
+
+
+def build_aggregate_query(query_input, params):
+    """
+    Wraps the crawl query so Redshift applies the metric set's aggregations itself: one row per dimension
+    combination and detector interval, using metrics_set, dimension_list, timestamp_column and
+    detector_frequency from params.json.
+    """
+    timestamp = params['timestamp_column']['ColumnName']
+    dimensions = params['dimension_list']
+    interval = truncate_timestamp(timestamp, params['detector_frequency'])
+    metrics = [AGGREGATION_FUNCTIONS[metric['AggregationFunction'].upper()] + "(" + metric['MetricName'] + ") as " +
+               metric['MetricName'] for metric in params['metrics_set']]
+    return "select " + ", ".join([interval + " as " + timestamp] + dimensions + metrics) + \
+           " from (" + query_input + ") as source group by " + ", ".join([interval] + dimensions)
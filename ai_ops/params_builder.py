@@ -3,6 +3,9 @@ import sys
 import json
 import boto3
 
+sys.path.append('lambdas/shared/python')
+from schedule import get_path_template
+
 # Open params and read as a dict
 with open('params.json') as f:
     data = json.load(f)
@@ -11,7 +14,8 @@ with open('params.json') as f:
 role_arn = sys.argv[1]
 
 s3_path_backtest = "s3://" + sys.argv[2] + '/ecommerce/backtest/'
-s3_path_continuous = "s3://" + sys.argv[2] + '/ecommerce/live/{{yyyyMMdd}}/{{HHmm}}'
+# The partitions the continuous crawl writes depend on the detector frequency
+s3_path_continuous = "s3://" + sys.argv[2] + '/ecommerce/live/' + get_path_template(data['detector_frequency'])
 s3_path_continuous_root = "s3://" + sys.argv[2] + '/ecommerce/live/'
 
 sts = boto3.client("sts")
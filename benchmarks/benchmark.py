@@ -0,0 +1,342 @@
+"""
+Purpose
+
+Runs the Lambda handlers end to end against the in-process fakes in fakes.py and reports, per handler, the wall
+time, the simulated time spent waiting on Redshift and the API, an estimate of the billed Lambda duration, the
+number of API calls by operation and the phase timings from the EMF metrics the handlers emit.
+
+The ecommerce tables are filled with the output of data/synth_data.py, so no AWS account is needed:
+
+    python benchmarks/benchmark.py --days 90 --statement-seconds 20 --json results.json
+"""
+
+import argparse
+import importlib.util
+import json
+import math
+import os
+import sys
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAMBDAS = os.path.join(ROOT, 'ai_ops', 'lambdas')
+sys.path[:0] = [os.path.join(LAMBDAS, 'shared', 'python'), os.path.join(ROOT, 'data'), os.path.dirname(__file__)]
+
+import clients  # noqa: E402
+import metrics  # noqa: E402
+import parameters  # noqa: E402
+from actions import ResourcePending  # noqa: E402
+from fakes import VirtualClock, FakeContext, CountingClient, FakeS3, FakeSecretsManager, FakeStepFunctions, \
+    FakeLookoutMetrics, FakeRedshiftData, connect_sqlite, load_ecommerce, TIMESTAMP_FORMAT  # noqa: E402
+
+BUCKET = 'benchmark-input-bucket'
+SECRET_NAME = 'redshift-benchmark'
+STATE_MACHINE_ARN = 'arn:aws:states:local:000000000000:stateMachine:benchmark'
+# Wait states and Retry of the state machine in template.yaml
+HISTORICAL_WAIT_SECONDS = 30
+STATUS_RETRY_INTERVAL = 30
+STATUS_RETRY_BACKOFF = 1.5
+STATUS_RETRY_ATTEMPTS = 20
+STATUS_RETRY_MAX_DELAY = 300
+
+
+def load_handler(path, name):
+    """
+    Imports a Lambda file by path, the file names contain dashes so they cannot be imported by name.
+    """
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class Environment:
+    """
+    One set of fakes shared by every handler, with fresh call counters per measured run.
+    """
+
+    def __init__(self, df, statement_seconds, queue_seconds, api_latency, activation_seconds, page_size):
+        self.clock = VirtualClock()
+        connection = connect_sqlite()
+        load_ecommerce(connection, df)
+        self.s3 = FakeS3()
+        self.services = {
+            's3': self.s3,
+            'redshift-data': FakeRedshiftData(connection, self.s3, self.clock, statement_seconds, page_size,
+                                              queue_seconds),
+            'secretsmanager': FakeSecretsManager({SECRET_NAME: {'dbClusterIdentifier': 'benchmark', 'db': 'dev'}}),
+            'stepfunctions': FakeStepFunctions(),
+            'lookoutmetrics': FakeLookoutMetrics(self.clock, activation_seconds),
+        }
+        self.api_latency = api_latency
+        self.calls = Counter()
+        self.emf_lines = []
+        metrics.set_sink(self.emf_lines.append)
+
+    def install(self):
+        self.calls = Counter()
+        clients._clients.clear()
+        clients._clients.update({name: CountingClient(name, service, self.calls, self.clock, self.api_latency)
+                                 for name, service in self.services.items()})
+
+    def measure(self, name, run):
+        """
+        Runs run(context) under the virtual clock.
+        :return: dict of the measurements and the result of run
+        """
+        self.install()
+        del self.emf_lines[:]
+        redshift = self.services['redshift-data']
+        engine_before = redshift.engine_seconds
+        self.clock.install()
+        simulated_before = self.clock.monotonic()
+        started = time.perf_counter()
+        try:
+            result = run()
+        finally:
+            wall = time.perf_counter() - started
+            self.clock.uninstall()
+        # Time spent inside SQLite stands in for Redshift, not for the Lambda
+        wall -= redshift.engine_seconds - engine_before
+        simulated = self.clock.monotonic() - simulated_before
+        return {'handler': name,
+                'wall_seconds': round(wall, 3),
+                'simulated_seconds': round(simulated, 3),
+                'api_calls': sum(self.calls.values()),
+                'api_calls_by_operation': dict(sorted(self.calls.items())),
+                'phases_ms': sum_phases(self.emf_lines),
+                'emf': list(self.emf_lines),
+                'result': result}
+
+
+def sum_phases(emf_lines):
+    """
+    Adds up the phase timings (metrics ending in Time) of the EMF lines of all invocations of a handler.
+    """
+    phases = Counter()
+    for line in emf_lines:
+        record = json.loads(line)
+        for metric in record['_aws']['CloudWatchMetrics'][0]['Metrics']:
+            if metric['Name'].endswith('Time'):
+                phases[metric['Name'][:-len('Time')]] += record[metric['Name']]
+    return {name: round(value, 1) for name, value in sorted(phases.items())}
+
+
+def invoke(module, event, env, invocations, timeout_seconds):
+    """
+    Calls module.lambda_handler, counting invocations and the billed duration of each one (rounded up to 1ms).
+    """
+    context = FakeContext(env.clock, timeout_seconds)
+    started_wall = time.perf_counter()
+    started_simulated = env.clock.monotonic()
+    engine_before = env.services['redshift-data'].engine_seconds
+    try:
+        return module.lambda_handler(event, context)
+    finally:
+        wall = time.perf_counter() - started_wall - (env.services['redshift-data'].engine_seconds - engine_before)
+        invocations.append(math.ceil((wall + env.clock.monotonic() - started_simulated) * 1000))
+
+
+def get_params():
+    with open(os.path.join(ROOT, 'ai_ops', 'params.json')) as params_file:
+        params = json.load(params_file)
+    params['secret_name'] = SECRET_NAME
+    params['metric_source']['S3SourceConfig']['HistoricalDataPathList'] = ['s3://' + BUCKET + '/ecommerce/backtest/']
+    params['s3_path_continuous_root'] = 's3://' + BUCKET + '/ecommerce/live/'
+    return params
+
+
+def run_historical(env, params, timeout_seconds):
+    module = load_handler(os.path.join(LAMBDAS, 'redshift', 'redshift-historical-crawl',
+                                       'redshift-historical-crawl.py'), 'historical_crawl')
+    invocations = []
+
+    def run():
+        # Mirrors the Historical Crawl Complete? choice and its Wait state
+        event = dict(params)
+        with working_directory(os.path.dirname(module.__file__)):
+            while True:
+                response = invoke(module, event, env, invocations, timeout_seconds)
+                if response['complete']:
+                    return response['result']
+                event['crawl'] = response
+                time.sleep(HISTORICAL_WAIT_SECONDS)
+    return env.measure('redshift-historical-crawl', run), invocations
+
+
+def run_continuous(env, params, catchup_hours, timeout_seconds):
+    module = load_handler(os.path.join(LAMBDAS, 'redshift', 'redshift-continuous-crawl',
+                                       'redshift-continuous-crawl.py'), 'continuous_crawl')
+    watermark = datetime.utcnow().replace(minute=0, second=0, microsecond=0) - timedelta(hours=catchup_hours)
+    env.s3.put_object(Bucket=BUCKET, Key=module.STATE_KEY,
+                      Body=json.dumps({'watermarks': {module.DEFAULT_QUERY_NAME: watermark.strftime(TIMESTAMP_FORMAT)}}))
+    invocations = []
+
+    def run():
+        with working_directory(os.path.dirname(module.__file__)):
+            return invoke(module, {}, env, invocations, timeout_seconds)['result']
+    return env.measure('redshift-continuous-crawl', run), invocations
+
+
+def run_detector(env, params, timeout_seconds):
+    module = load_handler(os.path.join(LAMBDAS, 'create-and-activate-detector', 'create-and-activate-detector.py'),
+                          'create_and_activate_detector')
+    invocations = []
+
+    def run():
+        detectors = invoke(module, dict(params), env, invocations, timeout_seconds)
+        # Mirrors the Retry of the Check Detector Status state
+        status_module = type('StatusHandler', (), {'lambda_handler': staticmethod(module.status_handler)})
+        interval = STATUS_RETRY_INTERVAL
+        for attempt in range(STATUS_RETRY_ATTEMPTS + 1):
+            try:
+                return invoke(status_module, detectors, env, invocations, timeout_seconds)
+            except ResourcePending:
+                time.sleep(interval)
+                interval = min(interval * STATUS_RETRY_BACKOFF, STATUS_RETRY_MAX_DELAY)
+        return 'still pending'
+    return env.measure('create-and-activate-detector', run), invocations
+
+
+def run_parse(env, params, records, buckets):
+    for i in range(buckets):
+        env.s3.put_object(Bucket=BUCKET + str(i), Key='params.json', Body=json.dumps(params))
+    os.environ['STEP_FUNCTIONS_ARN'] = STATE_MACHINE_ARN
+    os.environ['PARAMS_FILE'] = 'params.json'
+    env.install()
+    module = load_handler(os.path.join(LAMBDAS, 's3lambda', 'parse.py'), 'parse')
+    now = datetime.utcnow()
+    event = {'Records': [{'eventTime': (now + timedelta(seconds=i)).strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+                          's3': {'bucket': {'name': BUCKET + str(i % buckets)},
+                                 'object': {'key': 'ecommerce/upload-{}.csv'.format(i), 'sequencer': '{:016X}'.format(i)}}}
+                         for i in range(records)]}
+    invocations = []
+
+    def run():
+        # The client is created when parse.py is imported, swap in the counting one of this run
+        module.STEP_FUNCTIONS_CLI = clients.get_client('stepfunctions')
+        return json.loads(invoke(module, event, env, invocations, 60))
+    return env.measure('s3lambda-parse', run), invocations
+
+
+def run_notify(env, params, anomaly_groups, timeout_seconds):
+    detector_arn = 'arn:aws:lookoutmetrics:local:000000000000:AnomalyDetector:' + params['detector_name']
+    env.services['lookoutmetrics'].add_anomaly_groups(
+        detector_arn, anomaly_groups, [metric['MetricName'] for metric in params['metrics_set']])
+    os.environ['ExportBucketName'] = BUCKET
+    module = load_handler(os.path.join(LAMBDAS, 'notify', 'notify.py'), 'notify')
+    # One alert per anomaly group, as Lookout for Metrics sends them
+    events = [{'anomalyDetectorArn': detector_arn, 'alertEventId': 'alert-{}'.format(i),
+               'anomalyGroupId': group['AnomalyGroupId'], 'anomalyGroupScore': group['AnomalyGroupScore']}
+              for i, group in enumerate(env.services['lookoutmetrics'].anomaly_groups.values())]
+    invocations = []
+
+    def run():
+        results = [invoke(module, event, env, invocations, timeout_seconds) for event in events]
+        return {'exported': sum(result['exported'] for result in results),
+                'skipped': sum(not result['exported'] for result in results),
+                'objects': len({result['key'] for result in results if result['exported']})}
+    return env.measure('notify', run), invocations
+
+
+class working_directory:
+    # The crawls read query.sql relative to the working directory, as they do in Lambda
+
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        self.previous = os.getcwd()
+        os.chdir(self.path)
+
+    def __exit__(self, *args):
+        os.chdir(self.previous)
+
+
+def synthesize(days, seed, dataset=None):
+    """
+    The ecommerce data from now - days up to now, synthesized with the vectorized generator or read from a
+    Parquet/Arrow file written by synth_data.generate_data(output_format=...).
+    """
+    import synth_data
+    now = datetime.utcnow()
+    if dataset:
+        return synth_data.read_columnar(dataset, columns=['timestamp', 'platform', 'marketplace', 'views', 'revenue'],
+                                        start=now - timedelta(days=days), end=now)
+    df = synth_data.synthesize_vectorized(seed)
+    return df[(df['timestamp'] >= now - timedelta(days=days)) & (df['timestamp'] < now)]
+
+
+def print_report(reports, memory_mb):
+    print("{:<30} {:>6} {:>10} {:>12} {:>12} {:>10} {:>9}".format(
+        'handler', 'calls', 'wall s', 'simulated s', 'billed ms', 'GB-s', 'API calls'))
+    for report in reports:
+        print("{:<30} {:>6} {:>10.3f} {:>12.1f} {:>12} {:>10.2f} {:>9}".format(
+            report['handler'], report['invocations'], report['wall_seconds'], report['simulated_seconds'],
+            report['billed_ms'], report['billed_ms'] / 1000 * memory_mb / 1024, report['api_calls']))
+        for operation, count in report['api_calls_by_operation'].items():
+            print("    {:<40} {:>6}".format(operation, count))
+        for phase, milliseconds in report['phases_ms'].items():
+            print("    {:<40} {:>9.1f} ms".format(phase, milliseconds))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--days', type=int, default=90, help='days of history to synthesize')
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--dataset', help='read the data from this .parquet or .arrow file instead of synthesizing it')
+    parser.add_argument('--statement-seconds', type=float, default=10.0,
+                        help='simulated run time of every Redshift statement')
+    parser.add_argument('--queue-seconds', type=float, default=0.0,
+                        help='simulated time every Redshift statement is queued before it runs')
+    parser.add_argument('--api-latency-ms', type=float, default=20.0, help='simulated latency of every API call')
+    parser.add_argument('--activation-seconds', type=float, default=300.0,
+                        help='simulated time until a detector is active')
+    parser.add_argument('--page-size', type=int, default=1000, help='rows per get_statement_result page')
+    parser.add_argument('--catchup-hours', type=int, default=6,
+                        help='intervals the continuous crawl is behind when it starts')
+    parser.add_argument('--detector-frequency', help='override detector_frequency of params.json, e.g. PT5M')
+    parser.add_argument('--backfill', action='store_true', help='let the continuous crawl fill missing partitions')
+    parser.add_argument('--records', type=int, default=10, help='S3 event records per parse invocation')
+    parser.add_argument('--buckets', type=int, default=2, help='buckets the S3 event records are spread over')
+    parser.add_argument('--anomaly-groups', type=int, default=200,
+                        help='anomaly groups alerted to the notify Lambda, one invocation each')
+    parser.add_argument('--timeout', type=int, default=900, help='Lambda timeout in seconds')
+    parser.add_argument('--memory-mb', type=int, default=1024, help='Lambda memory used for the GB-s estimate')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    df = synthesize(args.days, args.seed, args.dataset)
+    env = Environment(df, args.statement_seconds, args.queue_seconds, args.api_latency_ms / 1000,
+                      args.activation_seconds,
+                      args.page_size)
+    # Keep the params cache of this run away from /tmp entries of earlier runs
+    parameters.CACHE_DIR = tempfile.mkdtemp()
+    params = get_params()
+    if args.detector_frequency:
+        params['detector_frequency'] = args.detector_frequency
+    params['continuous_backfill'] = args.backfill
+    env.s3.put_object(Bucket=BUCKET, Key='params.json', Body=json.dumps(params))
+    os.environ['InputBucketName'] = BUCKET
+
+    reports = []
+    for report, invocations in (run_historical(env, params, args.timeout),
+                                run_continuous(env, params, args.catchup_hours, args.timeout),
+                                run_detector(env, params, args.timeout),
+                                run_parse(env, params, args.records, args.buckets),
+                                run_notify(env, params, args.anomaly_groups, args.timeout)):
+        report.update({'invocations': len(invocations), 'billed_ms': sum(invocations)})
+        reports.append(report)
+
+    print("{} rows, {} S3 bytes written".format(len(df), env.s3.bytes_written))
+    print_report(reports, args.memory_mb)
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(reports, json_file, indent=2, default=str)
+
+
+if __name__ == '__main__':
+    main()
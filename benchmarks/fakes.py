@@ -0,0 +1,539 @@
+"""
+Purpose
+
+In-process stand-ins for the AWS services the Lambdas talk to, so the handlers can be run and measured offline.
+
+* FakeRedshiftData runs the crawl SQL against SQLite, including UNLOAD which writes CSV (optionally gzipped) into FakeS3,
+  and completes statements after a configurable run time on a virtual clock.
+* FakeS3, FakeSecretsManager, FakeStepFunctions and FakeLookoutMetrics keep their state in dictionaries.
+* VirtualClock replaces time.sleep/time.monotonic while a handler runs, so waiting costs no real time but still shows up
+  in the billed duration estimate.
+* CountingClient counts every API call (and advances the clock by a per-call latency), both for the benchmark and
+  for the EMF metrics of the handler.
+"""
+
+import csv
+import gzip
+import hashlib
+import io
+import itertools
+import json
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+from botocore.exceptions import ClientError
+from metrics import record_api_call
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+# Virtual clock time 0, for the timestamps the fakes return
+EPOCH = datetime(2020, 1, 1)
+
+
+def client_error(code, operation, message=''):
+    return ClientError({'Error': {'Code': code, 'Message': message}}, operation)
+
+
+class VirtualClock:
+    """
+    A clock that only moves when something sleeps or an API call is made. install() patches time.sleep and
+    time.monotonic so every module that uses them sees the virtual time.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.now = 0.0
+        self._patched = None
+
+    def advance(self, seconds):
+        with self._lock:
+            self.now += max(seconds, 0)
+
+    def sleep(self, seconds):
+        self.advance(seconds)
+
+    def monotonic(self):
+        with self._lock:
+            return self.now
+
+    def install(self):
+        self._patched = (time.sleep, time.monotonic)
+        time.sleep = self.sleep
+        time.monotonic = self.monotonic
+
+    def uninstall(self):
+        time.sleep, time.monotonic = self._patched
+
+
+class FakeContext:
+    """
+    Lambda context whose remaining time follows the virtual clock.
+    """
+
+    def __init__(self, clock, timeout_seconds=900):
+        self.clock = clock
+        self.deadline = clock.monotonic() + timeout_seconds
+
+    def get_remaining_time_in_millis(self):
+        return int((self.deadline - self.clock.monotonic()) * 1000)
+
+
+class FakePaginator:
+
+    def __init__(self, operation, token_key, result_keys):
+        self.operation = operation
+        self.token_key = token_key
+        self.result_keys = result_keys
+
+    def paginate(self, **kwargs):
+        while True:
+            page = self.operation(**kwargs)
+            yield page
+            if not page.get(self.token_key):
+                return
+            kwargs[self.token_key] = page[self.token_key]
+
+
+class CountingClient:
+    """
+    Proxy that counts calls per operation on the wrapped fake, e.g. counter['redshift-data.describe_statement'].
+    """
+
+    def __init__(self, service_name, client, counter, clock=None, latency=0.0):
+        self._service_name = service_name
+        self._client = client
+        self._counter = counter
+        self._clock = clock
+        self._latency = latency
+        self._lock = threading.Lock()
+
+    def _count(self, operation_name):
+        with self._lock:
+            self._counter[self._service_name + '.' + operation_name] += 1
+        record_api_call(self._service_name + '.' + operation_name)
+        if self._clock is not None:
+            self._clock.advance(self._latency)
+
+    def get_paginator(self, operation_name):
+        paginator = self._client.get_paginator(operation_name)
+        operation = paginator.operation
+
+        def counted(**kwargs):
+            self._count(operation_name)
+            return operation(**kwargs)
+        paginator.operation = counted
+        return paginator
+
+    def __getattr__(self, name):
+        attribute = getattr(self._client, name)
+        if not callable(attribute) or name.startswith('_'):
+            return attribute
+
+        def call(*args, **kwargs):
+            self._count(name)
+            return attribute(*args, **kwargs)
+        return call
+
+
+class FakeS3:
+
+    def __init__(self):
+        self.objects = {}
+        self.bytes_written = 0
+        self._lock = threading.Lock()
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        body = Body.encode('utf-8') if isinstance(Body, str) else Body
+        with self._lock:
+            self.objects[(Bucket, Key)] = body
+            self.bytes_written += len(body)
+        return {'ETag': '"' + hashlib.md5(body).hexdigest() + '"'}
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, **kwargs):
+        self.put_object(Bucket=Bucket, Key=Key, Body=Fileobj.read())
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None, **kwargs):
+        with self._lock:
+            body = self.objects.get((Bucket, Key))
+        if body is None:
+            raise client_error('NoSuchKey', 'GetObject')
+        etag = '"' + hashlib.md5(body).hexdigest() + '"'
+        if IfNoneMatch == etag:
+            raise client_error('304', 'GetObject', 'Not Modified')
+        return {'Body': io.BytesIO(body), 'ETag': etag, 'ContentLength': len(body)}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        response = self.get_object(Bucket, Key)
+        del response['Body']
+        return response
+
+    def list_objects_v2(self, Bucket, Prefix='', ContinuationToken=None, MaxKeys=1000, StartAfter='', **kwargs):
+        with self._lock:
+            keys = sorted(key for bucket, key in self.objects
+                          if bucket == Bucket and key.startswith(Prefix) and key > StartAfter)
+        start = int(ContinuationToken or 0)
+        page = keys[start:start + MaxKeys]
+        response = {'Contents': [{'Key': key, 'Size': len(self.objects[(Bucket, key)])} for key in page],
+                    'KeyCount': len(page)}
+        if start + MaxKeys < len(keys):
+            response['NextContinuationToken'] = str(start + MaxKeys)
+        return response
+
+    def get_paginator(self, operation_name):
+        if operation_name != 'list_objects_v2':
+            raise NotImplementedError(operation_name)
+
+        return FakeS3Paginator(self.list_objects_v2)
+
+    def read_text(self, bucket, key):
+        body = self.objects[(bucket, key)]
+        return gzip.decompress(body).decode('utf-8') if key.endswith('.gz') else body.decode('utf-8')
+
+
+class FakeS3Paginator(FakePaginator):
+    """
+    list_objects_v2 returns the continuation token under a different name than it accepts it.
+    """
+
+    def __init__(self, operation):
+        super().__init__(operation, 'ContinuationToken', ['Contents'])
+
+    def paginate(self, **kwargs):
+        while True:
+            page = self.operation(**kwargs)
+            yield page
+            if not page.get('NextContinuationToken'):
+                return
+            kwargs['ContinuationToken'] = page['NextContinuationToken']
+
+
+def split_s3_url(url):
+    match = re.match(r's3://([^/]+)/?(.*)', url)
+    return match.group(1), match.group(2)
+
+
+class FakeSecretsManager:
+
+    def __init__(self, secrets):
+        self.secrets = secrets
+
+    def get_secret_value(self, SecretId):
+        if SecretId not in self.secrets:
+            raise client_error('ResourceNotFoundException', 'GetSecretValue')
+        return {'ARN': 'arn:aws:secretsmanager:local:000000000000:secret:' + SecretId,
+                'Name': SecretId,
+                'SecretString': json.dumps(self.secrets[SecretId])}
+
+
+def _date_trunc(unit, value):
+    value = datetime.fromisoformat(value)
+    if unit == 'hour':
+        value = value.replace(minute=0, second=0, microsecond=0)
+    elif unit == 'day':
+        value = value.replace(hour=0, minute=0, second=0, microsecond=0)
+    elif unit == 'minute':
+        value = value.replace(second=0, microsecond=0)
+    return value.strftime(TIMESTAMP_FORMAT)
+
+
+def _dateadd(unit, amount, value):
+    return (datetime.fromisoformat(value) + timedelta(**{unit + 's': amount})).strftime(TIMESTAMP_FORMAT)
+
+
+def _datediff(unit, start, end):
+    seconds = (datetime.fromisoformat(end) - datetime.fromisoformat(start)).total_seconds()
+    return int(seconds // {'minute': 60, 'hour': 3600, 'day': 86400}[unit])
+
+
+def connect_sqlite():
+    """
+    SQLite connection with the Redshift date functions the crawl queries use.
+    """
+    connection = sqlite3.connect(':memory:', check_same_thread=False)
+    connection.create_function('date_trunc', 2, _date_trunc, deterministic=True)
+    connection.create_function('dateadd', 3, _dateadd, deterministic=True)
+    connection.create_function('datediff', 3, _datediff, deterministic=True)
+    return connection
+
+
+def load_ecommerce(connection, df):
+    """
+    Loads a synth_data DataFrame into the platform, marketplace and ecommerce tables used by the crawl queries.
+    """
+    cursor = connection.cursor()
+    cursor.execute('create table platform (id integer primary key, name text)')
+    cursor.execute('create table marketplace (id integer primary key, name text)')
+    cursor.execute('create table ecommerce (id integer primary key, ts text not null, platform integer not null, '
+                   'marketplace integer not null, views integer, revenue real)')
+    ids = {}
+    for table in ('platform', 'marketplace'):
+        names = sorted(df[table].unique())
+        ids[table] = {name: i for i, name in enumerate(names)}
+        cursor.executemany('insert into ' + table + ' (id, name) values (?, ?)',
+                           [(i, name) for name, i in ids[table].items()])
+    rows = zip(df['timestamp'].dt.strftime(TIMESTAMP_FORMAT),
+               df['platform'].map(ids['platform']).astype(int).tolist(),
+               df['marketplace'].map(ids['marketplace']).astype(int).tolist(),
+               df['views'].astype(int).tolist(),
+               df['revenue'].astype(float).tolist())
+    cursor.executemany('insert into ecommerce (ts, platform, marketplace, views, revenue) values (?, ?, ?, ?, ?)', rows)
+    cursor.execute('create index ecommerce_ts on ecommerce (ts)')
+    connection.commit()
+
+
+UNLOAD_PATTERN = re.compile(r"^\s*unload\s*\('(.*)'\)\s*to\s*'([^']*)'\s*iam_role\s*'[^']*'(.*?);?\s*$",
+                            re.IGNORECASE | re.DOTALL)
+
+
+def _field(value):
+    if value is None:
+        return {'isNull': True}
+    if isinstance(value, bool):
+        return {'booleanValue': value}
+    if isinstance(value, int):
+        return {'longValue': value}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+class FakeRedshiftData:
+    """
+    Redshift Data API backed by SQLite. A statement is executed when it is submitted, waits queue_time virtual
+    seconds as SUBMITTED, then runs as STARTED for run_time virtual seconds before it reports FINISHED.
+    run_time is a number or a callable taking the SQL.
+    """
+
+    def __init__(self, connection, s3, clock, run_time=5.0, page_size=1000, queue_time=0.0):
+        self.connection = connection
+        self.s3 = s3
+        self.clock = clock
+        self.run_time = run_time
+        self.queue_time = queue_time
+        self.page_size = page_size
+        self.statements = {}
+        # Real time spent inside SQLite, so it can be told apart from the time of the handler
+        self.engine_seconds = 0.0
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def _run(self, sql):
+        started = time.perf_counter()
+        try:
+            return self._execute(sql)
+        finally:
+            with self._lock:
+                self.engine_seconds += time.perf_counter() - started
+
+    def _execute(self, sql):
+        match = UNLOAD_PATTERN.match(sql)
+        if match:
+            query, destination, options = match.group(1).replace("''", "'"), match.group(2), match.group(3).lower()
+            return self._unload(query, destination, options), [], []
+        with self._lock:
+            cursor = self.connection.execute(sql)
+            rows = cursor.fetchall()
+            columns = [{'name': column[0]} for column in cursor.description or []]
+        return None, columns, rows
+
+    def _unload(self, query, destination, options):
+        with self._lock:
+            cursor = self.connection.execute(query)
+            rows = cursor.fetchall()
+            header = [column[0] for column in cursor.description]
+        text = io.StringIO()
+        writer = csv.writer(text, lineterminator='\n')
+        if 'header' in options:
+            writer.writerow(header)
+        writer.writerows(rows)
+        body = text.getvalue().encode('utf-8')
+        key_suffix = '0000_part_00'
+        if 'gzip' in options:
+            body = gzip.compress(body)
+            key_suffix += '.gz'
+        bucket, prefix = split_s3_url(destination)
+        self.s3.put_object(Bucket=bucket, Key=prefix + key_suffix, Body=body)
+        return len(rows)
+
+    def _submit(self, sql_list, statement_name=None):
+        statement_id = 'stmt-{}'.format(next(self._ids))
+        statement = {'Id': statement_id, 'StatementName': statement_name, 'Status': 'SUBMITTED',
+                     'CreatedAt': self.clock.monotonic(), 'HasResultSet': False, 'QueryString': sql_list[-1]}
+        try:
+            for sql in sql_list:
+                rows_unloaded, columns, rows = self._run(sql)
+            statement.update({'HasResultSet': bool(columns), 'ColumnMetadata': columns, 'Rows': rows,
+                              'ResultRows': len(rows) if columns else rows_unloaded or 0})
+        except sqlite3.Error as e:
+            statement['Error'] = str(e)
+        run_time = self.run_time(sql_list[-1]) if callable(self.run_time) else self.run_time
+        statement['StartsAt'] = statement['CreatedAt'] + self.queue_time
+        statement['FinishesAt'] = statement['StartsAt'] + run_time
+        with self._lock:
+            self.statements[statement_id] = statement
+        return {'Id': statement_id}
+
+    def execute_statement(self, Sql, StatementName=None, **kwargs):
+        return self._submit([Sql], StatementName)
+
+    def batch_execute_statement(self, Sqls, StatementName=None, **kwargs):
+        return self._submit(Sqls, StatementName)
+
+    def _status(self, statement):
+        if self.clock.monotonic() < statement['StartsAt']:
+            return 'SUBMITTED'
+        if self.clock.monotonic() < statement['FinishesAt']:
+            return 'STARTED'
+        return 'FAILED' if 'Error' in statement else 'FINISHED'
+
+    def describe_statement(self, Id):
+        statement = self.statements[Id]
+        response = {key: statement[key] for key in ('Id', 'StatementName', 'HasResultSet', 'QueryString')}
+        response['Status'] = self._status(statement)
+        if response['Status'] == 'FAILED':
+            response['Error'] = statement['Error']
+        if response['Status'] == 'FINISHED':
+            response.update({'ResultRows': statement['ResultRows'],
+                             'CreatedAt': EPOCH + timedelta(seconds=statement['CreatedAt']),
+                             'UpdatedAt': EPOCH + timedelta(seconds=statement['FinishesAt']),
+                             'Duration': int((statement['FinishesAt'] - statement['StartsAt']) * 1e9)})
+        return response
+
+    def list_statements(self, StatementName=None, Status='ALL', NextToken=None, **kwargs):
+        with self._lock:
+            statements = list(self.statements.values())
+        matches = [{'Id': s['Id'], 'StatementName': s['StatementName'], 'Status': self._status(s)}
+                   for s in reversed(statements)
+                   if not StatementName or (s['StatementName'] or '').startswith(StatementName)]
+        if Status != 'ALL':
+            matches = [s for s in matches if s['Status'] == Status]
+        return {'Statements': matches}
+
+    def get_statement_result(self, Id, NextToken=None):
+        statement = self.statements[Id]
+        start = int(NextToken or 0)
+        rows = statement['Rows'][start:start + self.page_size]
+        response = {'ColumnMetadata': statement['ColumnMetadata'],
+                    'Records': [[_field(value) for value in row] for row in rows],
+                    'TotalNumRows': len(statement['Rows'])}
+        if start + self.page_size < len(statement['Rows']):
+            response['NextToken'] = str(start + self.page_size)
+        return response
+
+    def get_paginator(self, operation_name):
+        if operation_name != 'list_statements':
+            raise NotImplementedError(operation_name)
+        return FakePaginator(self.list_statements, 'NextToken', ['Statements'])
+
+
+class FakeStepFunctions:
+
+    def __init__(self):
+        self.executions = {}
+
+    def start_execution(self, stateMachineArn, name, input):
+        if name in self.executions and self.executions[name] != input:
+            raise client_error('ExecutionAlreadyExists', 'StartExecution')
+        self.executions[name] = input
+        return {'executionArn': stateMachineArn + ':' + name, 'startDate': datetime.utcnow()}
+
+
+class FakeLookoutMetrics:
+    """
+    Detectors report ACTIVATING for activation_time virtual seconds after activation, then ACTIVE.
+    """
+
+    def __init__(self, clock, activation_time=300.0):
+        self.clock = clock
+        self.activation_time = activation_time
+        self.detectors = {}
+        self.metric_sets = {}
+        self.anomaly_groups = {}
+        self._lock = threading.Lock()
+
+    def create_anomaly_detector(self, AnomalyDetectorName, **kwargs):
+        with self._lock:
+            if any(d['AnomalyDetectorName'] == AnomalyDetectorName for d in self.detectors.values()):
+                raise client_error('ConflictException', 'CreateAnomalyDetector')
+            arn = 'arn:aws:lookoutmetrics:local:000000000000:AnomalyDetector:' + AnomalyDetectorName
+            self.detectors[arn] = {'AnomalyDetectorName': AnomalyDetectorName, 'AnomalyDetectorArn': arn,
+                                   'Status': 'INACTIVE', 'ActivatedAt': None}
+        return {'AnomalyDetectorArn': arn}
+
+    def list_anomaly_detectors(self, **kwargs):
+        with self._lock:
+            return {'AnomalyDetectorSummaryList': [dict(d) for d in self.detectors.values()]}
+
+    def create_metric_set(self, AnomalyDetectorArn, MetricSetName, **kwargs):
+        with self._lock:
+            arn = AnomalyDetectorArn.replace(':AnomalyDetector:', ':MetricSet:') + ':' + MetricSetName
+            self.metric_sets[arn] = {'AnomalyDetectorArn': AnomalyDetectorArn, 'MetricSetName': MetricSetName,
+                                     'MetricSetArn': arn}
+        return {'MetricSetArn': arn}
+
+    def list_metric_sets(self, AnomalyDetectorArn, **kwargs):
+        with self._lock:
+            return {'MetricSetSummaryList': [dict(m) for m in self.metric_sets.values()
+                                             if m['AnomalyDetectorArn'] == AnomalyDetectorArn]}
+
+    def activate_anomaly_detector(self, AnomalyDetectorArn):
+        with self._lock:
+            detector = self.detectors[AnomalyDetectorArn]
+            if detector['ActivatedAt'] is not None:
+                raise client_error('ConflictException', 'ActivateAnomalyDetector')
+            detector['ActivatedAt'] = self.clock.monotonic()
+        return {}
+
+    def add_anomaly_groups(self, anomaly_detector_arn, count, metric_names, series_per_metric=3, points=24,
+                           start=datetime(2024, 1, 1)):
+        """
+        Adds count anomaly groups, one per hour from start, each impacting every metric in series_per_metric series.
+        """
+        with self._lock:
+            groups = self.anomaly_groups
+            for i in range(len(groups), len(groups) + count):
+                group_start = start + timedelta(hours=i)
+                groups['group-{:06d}'.format(i)] = {
+                    'AnomalyGroupId': 'group-{:06d}'.format(i),
+                    'AnomalyDetectorArn': anomaly_detector_arn,
+                    'StartTime': group_start.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                    'EndTime': (group_start + timedelta(hours=1)).strftime('%Y-%m-%dT%H:%M:%SZ'),
+                    'AnomalyGroupScore': float(i % 100),
+                    'PrimaryMetricName': metric_names[0],
+                    'MetricLevelImpactList': [{'MetricName': name, 'NumTimeSeries': series_per_metric,
+                                               'ContributionMatrix': {'DimensionContributionList': []}}
+                                              for name in metric_names],
+                    'series_per_metric': series_per_metric,
+                    'points': points,
+                }
+
+    def get_anomaly_group(self, AnomalyGroupId, AnomalyDetectorArn):
+        group = self.anomaly_groups[AnomalyGroupId]
+        return {'AnomalyGroup': {key: value for key, value in group.items()
+                                 if key not in ('series_per_metric', 'points')}}
+
+    def list_anomaly_group_time_series(self, AnomalyDetectorArn, AnomalyGroupId, MetricName, MaxResults=100,
+                                       NextToken=None):
+        group = self.anomaly_groups[AnomalyGroupId]
+        end = datetime.strptime(group['StartTime'], '%Y-%m-%dT%H:%M:%SZ')
+        first = int(NextToken or 0)
+        series = range(first, min(first + MaxResults, group['series_per_metric']))
+        response = {'AnomalyGroupId': AnomalyGroupId, 'MetricName': MetricName,
+                    'TimestampList': [(end + timedelta(hours=h)).strftime('%Y-%m-%dT%H:%M:%SZ')
+                                      for h in range(-group['points'] + 1, 1)],
+                    'TimeSeriesList': [{'TimeSeriesId': 'series-{}'.format(i),
+                                        'DimensionList': [{'DimensionName': 'platform', 'DimensionValue': str(i)}],
+                                        'MetricValueList': [float(h) for h in range(group['points'])]}
+                                       for i in series]}
+        if first + MaxResults < group['series_per_metric']:
+            response['NextToken'] = str(first + MaxResults)
+        return response
+
+    def describe_anomaly_detector(self, AnomalyDetectorArn):
+        with self._lock:
+            detector = dict(self.detectors[AnomalyDetectorArn])
+        if detector['ActivatedAt'] is not None:
+            ready = self.clock.monotonic() >= detector['ActivatedAt'] + self.activation_time
+            detector['Status'] = 'ACTIVE' if ready else 'ACTIVATING'
+        return detector
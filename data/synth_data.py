@@ -6,8 +6,18 @@ import datetime
 from datetime import date
 from dateutil.relativedelta import relativedelta
 import shutil
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
 import pandas as pd
 
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.fs as pafs
+except ImportError:
+    pa = None
+
 dataset_name = "ecommerce"
 
 frequency = "1H"
@@ -28,8 +38,10 @@ anomaly_size_range = (100, 600)
 anomaly_length_range = (1, 5 * 60)
 anomaly_possibility = 0.005
 
+# Each function takes the previous metric (the modelled value for the first one). The vectorized engines call
+# them with whole arrays, functions that only take scalars are applied element by element there.
 introduce_metric_from_upstream = [
-    lambda x: max(int(x), 0),  # sin curve -> views
+    lambda x: np.maximum(np.trunc(x), 0).astype(np.int64),  # sin curve -> views
     lambda x: x * 0.3,  # views -> revenue
 ]
 
@@ -111,74 +123,472 @@ class Item:
         return metric_values, is_anomaly
 
 
-def synthesize():
+def _to_dataframe(dimension_values_list, timestamp_list, metric_values_list, labels_list, dimension_names=None):
+    data = {}
+    for dimension_name, dimension_values in zip(dimension_names or dimensions.keys(), dimension_values_list):
+        data[dimension_name] = dimension_values
+    data["timestamp"] = timestamp_list
+    for metric_name, metric_values in zip(metrics, metric_values_list):
+        data[metric_name] = metric_values
+    for metric_name, labels in zip(metrics, labels_list):
+        data[metric_name + "_label"] = labels
+    return pd.DataFrame(data)
+
+
+def synthesize_chunks(chunk_length=None):
+    """
+    Generator version of synthesize(), yields one DataFrame per chunk_length time window (e.g. "7D").
+    With chunk_length=None the whole period is yielded as a single DataFrame.
+    """
     # create item list
     item_list = []
     for dimension_values in itertools.product(*dimensions.values()):
         item = Item(dict(zip(dimensions.keys(), dimension_values)))
         item_list.append(item)
 
-    # itereate and prepare data    
-    dimension_values_list = []
-    for i in range(len(dimensions)):
-        dimension_values_list.append([])
+    t = period[0]
+    while t < period[1]:
+        window_end = period[1] if chunk_length is None else min(t + pd.to_timedelta(chunk_length), period[1])
 
-    timestamp_list = []
+        # itereate and prepare data
+        dimension_values_list = []
+        for i in range(len(dimensions)):
+            dimension_values_list.append([])
 
-    metric_values_list = []
-    for i, metric in enumerate(metrics):
-        metric_values_list.append([])
+        timestamp_list = []
 
-    labels_list = []
-    for i, metric in enumerate(metrics):
-        labels_list.append([])
+        metric_values_list = []
+        for i, metric in enumerate(metrics):
+            metric_values_list.append([])
 
-    t = period[0]
-    while t < period[1]:
+        labels_list = []
+        for i, metric in enumerate(metrics):
+            labels_list.append([])
 
-        # print(t)
+        while t < window_end:
 
-        for item in item_list:
+            for item in item_list:
 
-            for i, d in enumerate(item.dimension.values()):
-                # print(i,d)
-                dimension_values_list[i].append(d)
+                for i, d in enumerate(item.dimension.values()):
+                    dimension_values_list[i].append(d)
 
-            timestamp_list.append(t)
+                timestamp_list.append(t)
 
-            metric_values, is_anomaly = item.get(t)
-            for i, metric_value in enumerate(metric_values):
-                metric_values_list[i].append(metric_value)
-                labels_list[i].append(int(is_anomaly))
+                metric_values, is_anomaly = item.get(t)
+                for i, metric_value in enumerate(metric_values):
+                    metric_values_list[i].append(metric_value)
+                    labels_list[i].append(int(is_anomaly))
 
-        t += pd.to_timedelta(frequency)
+            t += pd.to_timedelta(frequency)
 
-    # convert to DataFrame
-    data = {}
-    for dimension_name, dimension_values in zip(dimensions.keys(), dimension_values_list):
-        data[dimension_name] = dimension_values
-    data["timestamp"] = timestamp_list
-    for metric_name, metric_values in zip(metrics, metric_values_list):
-        data[metric_name] = metric_values
-    for metric_name, labels in zip(metrics, labels_list):
-        data[metric_name + "_label"] = labels
-    df = pd.DataFrame(data)
-    return df
+        # convert to DataFrame
+        yield _to_dataframe(dimension_values_list, timestamp_list, metric_values_list, labels_list)
 
 
-def splot_into_intervals(df, output_dirname):
-    for timestamp, df_single_timestamp in df.groupby("timestamp"):
+def synthesize():
+    return pd.concat(synthesize_chunks(), ignore_index=True)
+
+
+def _model_window(timestamps, item_parameters, noise, starts, lengths, sizes, signs, carried_steps, carried_offset):
+    """
+    Computes the (time x item) values of one window from its random draws: DailyPattern and RandomFactor
+    contributions plus the running anomalies, the one carried over from the previous window included.
+    :return: value and is_anomaly matrices, and the anomaly steps and offsets to carry into the next window
+    """
+    peak_size, peak_time, offset, random_factor_size = item_parameters
+    n_steps, n_items = noise.shape
+    step_minutes = pd.to_timedelta(frequency).total_seconds() / 60
+    item_index = np.arange(n_items)[None, :]
+
+    # DailyPattern.get()
+    minutes_in_day = (timestamps.hour * 60 + timestamps.minute).to_numpy(dtype=np.float64)[:, None]
+    value = np.cos(((minutes_in_day - peak_time) / (24 * 60)) * 2 * np.pi) * peak_size + peak_size + offset
+
+    # RandomFactor.get()
+    value += noise * random_factor_size
+
+    # Anomaly: a new anomaly replaces the running one, and lasts until its remaining time is used up
+    anomaly_steps = np.ceil(lengths / step_minutes)
+    anomaly_offset = sizes * (signs * 2 - 1)
+
+    step_index = np.arange(n_steps)[:, None]
+    last_start = np.maximum.accumulate(np.where(starts, step_index, -1), axis=0)
+    has_started = last_start >= 0
+    last_start = np.where(has_started, last_start, 0)
+    is_anomaly = np.where(has_started,
+                          step_index - last_start < anomaly_steps[last_start, item_index],
+                          step_index < carried_steps)
+    value += np.where(is_anomaly,
+                      np.where(has_started, anomaly_offset[last_start, item_index], carried_offset),
+                      0.0)
+
+    final_start = last_start[-1]
+    carried_steps = np.where(has_started[-1],
+                             anomaly_steps[final_start, item_index[0]] - (n_steps - final_start),
+                             carried_steps - n_steps)
+    carried_offset = np.where(has_started[-1], anomaly_offset[final_start, item_index[0]], carried_offset)
+    return value, is_anomaly, carried_steps, carried_offset
+
+
+def _introduce_metrics(value):
+    """
+    Array counterpart of the metric loop in Item.get(): chains introduce_metric_from_upstream over a value matrix.
+    :return: list of one flattened array per metric
+    """
+    metric_values_list = []
+    for i, metric in enumerate(metrics):
+        try:
+            result = np.asarray(introduce_metric_from_upstream[i](value))
+            if result.shape != np.shape(value):
+                raise TypeError("not an element-wise function")
+        except (TypeError, ValueError):
+            result = np.vectorize(introduce_metric_from_upstream[i])(value)
+        value = result
+        metric_values_list.append(value.ravel())
+    return metric_values_list
+
+
+def synthesize_vectorized_chunks(seed=1234, chunk_length=None):
+    """
+    NumPy equivalent of synthesize_chunks(). The (time x item) matrix of DailyPattern, RandomFactor and Anomaly
+    contributions is built as arrays for each chunk_length window instead of stepping through every hour and item
+    in Python. Running anomalies are carried over between windows, and every random quantity has its own stream,
+    so the output for a given seed is the same whatever the chunk_length.
+    """
+    noise_rng, start_rng, length_rng, size_rng, sign_rng, item_rng = \
+        [np.random.default_rng(s) for s in np.random.SeedSequence(seed).spawn(6)]
+
+    item_dimensions = list(itertools.product(*dimensions.values()))
+    n_items = len(item_dimensions)
+    step = pd.to_timedelta(frequency)
+
+    # per item parameters, equivalent of DailyPattern() and RandomFactor()
+    peak_size = item_rng.uniform(*daily_peak_size_range, size=n_items)
+    peak_time = item_rng.uniform(*daily_peak_time, size=n_items)
+    offset = item_rng.uniform(*daily_offset_range, size=n_items)
+    random_factor_size = item_rng.uniform(*random_factor_size_range, size=n_items)
+
+    # anomaly still running at the end of the previous window
+    carried_steps = np.zeros(n_items)
+    carried_offset = np.zeros(n_items)
+
+    window_start = period[0]
+    while window_start < period[1]:
+        window_end = period[1] if chunk_length is None else min(window_start + pd.to_timedelta(chunk_length),
+                                                                 period[1])
+        timestamps = pd.date_range(window_start, window_end, freq=step, inclusive="left")
+        n_steps = len(timestamps)
+        window_start = timestamps[-1] + step
+
+        value, is_anomaly, carried_steps, carried_offset = _model_window(
+            timestamps, (peak_size, peak_time, offset, random_factor_size),
+            noise_rng.uniform(-1.0, 1.0, size=(n_steps, n_items)),
+            start_rng.random((n_steps, n_items)) < anomaly_possibility,
+            length_rng.integers(anomaly_length_range[0], anomaly_length_range[1] + 1, size=(n_steps, n_items)),
+            size_rng.uniform(*anomaly_size_range, size=(n_steps, n_items)),
+            sign_rng.integers(0, 2, size=(n_steps, n_items)),
+            carried_steps, carried_offset)
+
+        # introduce_metric_from_upstream
+        metric_values_list = _introduce_metrics(value)
+
+        # rows ordered by timestamp then item as in synthesize()
+        dimension_values_list = [np.tile([d[i] for d in item_dimensions], n_steps) for i in range(len(dimensions))]
+        labels = is_anomaly.astype(np.int64).ravel()
+        yield _to_dataframe(dimension_values_list, np.repeat(timestamps.to_numpy(), n_items),
+                            metric_values_list, [labels] * len(metrics))
+
+
+def synthesize_vectorized(seed=1234):
+    return pd.concat(synthesize_vectorized_chunks(seed), ignore_index=True)
+
+
+def _draw_item_parameters(seed, first_item, n_items):
+    """
+    Draws the DailyPattern and RandomFactor parameters of consecutive items, each from a stream seeded by
+    (seed, item). They are fixed for the whole period, so every shard draws them only once.
+    :return: (4 x item) array of peak size, peak time, offset and random factor size
+    """
+    parameters = np.empty((4, n_items))
+    for column, item in enumerate(range(first_item, first_item + n_items)):
+        item_rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(item,)))
+        parameters[:, column] = [item_rng.uniform(*daily_peak_size_range), item_rng.uniform(*daily_peak_time),
+                                 item_rng.uniform(*daily_offset_range), item_rng.uniform(*random_factor_size_range)]
+    return parameters
+
+
+def _synthesize_shard(seed, first_item, parameters, window_index, timestamps, carried_steps, carried_offset):
+    """
+    Generates one window of a shard of consecutive items, with the item parameters of _draw_item_parameters().
+    The window's randomness comes from a stream per item seeded by (seed, item, window), so a shard computes the
+    same values whichever process runs it and whatever other items share it.
+    :return: value and is_anomaly (time x item) and the anomaly state to carry into the next window
+    """
+    n_steps, n_items = len(timestamps), parameters.shape[1]
+    draws = {name: np.empty((n_steps, n_items)) for name in ("noise", "starts", "lengths", "sizes", "signs")}
+    for column, item in enumerate(range(first_item, first_item + n_items)):
+        rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(item, window_index)))
+        draws["noise"][:, column] = rng.uniform(-1.0, 1.0, size=n_steps)
+        draws["starts"][:, column] = rng.random(n_steps)
+        draws["lengths"][:, column] = rng.integers(anomaly_length_range[0], anomaly_length_range[1] + 1, size=n_steps)
+        draws["sizes"][:, column] = rng.uniform(*anomaly_size_range, size=n_steps)
+        draws["signs"][:, column] = rng.integers(0, 2, size=n_steps)
+
+    value, is_anomaly, carried_steps, carried_offset = _model_window(
+        timestamps, parameters, draws["noise"], draws["starts"] < anomaly_possibility, draws["lengths"],
+        draws["sizes"], draws["signs"], carried_steps, carried_offset)
+    return value, is_anomaly, carried_steps, carried_offset
+
+
+def synthesize_sharded_chunks(seed=1234, shard_length="30D", items_per_shard=1000, max_workers=None,
+                              dimension_values=None):
+    """
+    Multi-core counterpart of synthesize_vectorized_chunks(), yields one DataFrame per shard_length window and
+    shard. The dimension combinations (dimension_values, the module's dimensions by default, e.g. a dict with
+    10^5+ combinations) are split into shards of items_per_shard items that a process pool generates
+    independently; running anomalies are handed from one window to the next. Only a few shards per worker are
+    in flight at a time, so memory follows items_per_shard rather than the number of combinations.
+    Every item and window has its own seeded sub-stream, so for a given seed and shard_length the rows are
+    bit-identical whatever max_workers and items_per_shard are; frames come window by window, shard by shard,
+    so the row order follows items_per_shard. It differs from synthesize_vectorized(), which draws from
+    shared streams.
+    """
+    dimension_values = dimension_values or dimensions
+    item_dimensions = list(itertools.product(*dimension_values.values()))
+    shards = [(first, item_dimensions[first:first + items_per_shard])
+              for first in range(0, len(item_dimensions), items_per_shard)]
+    carried = [(np.zeros(len(shard)), np.zeros(len(shard))) for _, shard in shards]
+    step = pd.to_timedelta(frequency)
+    max_in_flight = 2 * (max_workers or os.cpu_count() or 1)
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        parameters = list(executor.map(_draw_item_parameters, *zip(*[(seed, first, len(shard))
+                                                                     for first, shard in shards])))
+        window_start, window_index = period[0], 0
+        while window_start < period[1]:
+            window_end = min(window_start + pd.to_timedelta(shard_length), period[1])
+            timestamps = pd.date_range(window_start, window_end, freq=step, inclusive="left")
+            def to_dataframe(shard_index, future):
+                value, is_anomaly, steps, offsets = future.result()
+                carried[shard_index] = (steps, offsets)
+                # rows ordered by timestamp then item of the shard
+                shard = shards[shard_index][1]
+                dimension_values_list = [np.tile([d[i] for d in shard], len(timestamps))
+                                         for i in range(len(dimension_values))]
+                labels = is_anomaly.astype(np.int64).ravel()
+                return _to_dataframe(dimension_values_list, np.repeat(timestamps.to_numpy(), len(shard)),
+                                     _introduce_metrics(value), [labels] * len(metrics),
+                                     dimension_names=list(dimension_values.keys()))
+
+            in_flight = deque()
+            for shard_index, (first, _) in enumerate(shards):
+                steps, offsets = carried[shard_index]
+                in_flight.append((shard_index, executor.submit(_synthesize_shard, seed, first, parameters[shard_index],
+                                                               window_index, timestamps, steps, offsets)))
+                if len(in_flight) >= max_in_flight:
+                    yield to_dataframe(*in_flight.popleft())
+            while in_flight:
+                yield to_dataframe(*in_flight.popleft())
+            window_start, window_index = timestamps[-1] + step, window_index + 1
+
+
+def synthesize_sharded(seed=1234, max_workers=None, dimension_values=None):
+    return pd.concat(synthesize_sharded_chunks(seed, max_workers=max_workers, dimension_values=dimension_values),
+                     ignore_index=True)
+
+
+def _write_intervals(df_sorted, output_dirname):
+    """
+    Writes one %Y%m%d/%H%M csv per timestamp of a frame that is already sorted by timestamp.
+    """
+    if df_sorted.empty:
+        return 0
+    timestamps = df_sorted["timestamp"].to_numpy()
+    bounds = np.concatenate(([0], np.flatnonzero(timestamps[1:] != timestamps[:-1]) + 1, [len(timestamps)]))
+    for begin, end in zip(bounds[:-1], bounds[1:]):
+        timestamp = pd.Timestamp(timestamps[begin])
         dirname = os.path.join(output_dirname, timestamp.strftime("%Y%m%d/%H%M"))
         filename = os.path.join(dirname, timestamp.strftime("%Y%m%d_%H%M%S.csv"))
 
-        if not os.path.exists(dirname):
-            os.makedirs(dirname)
-
-        df_single_timestamp.to_csv(filename, index=False, date_format="%Y-%m-%d %H:%M:%S")
-
-
-def generate_data():
-    df_full = synthesize()
+        os.makedirs(dirname, exist_ok=True)
+
+        df_sorted.iloc[begin:end].to_csv(filename, index=False, date_format="%Y-%m-%d %H:%M:%S")
+    return len(bounds) - 1
+
+
+def splot_into_intervals(df, output_dirname, max_workers=None, use_processes=False, by_day=False, start=None,
+                         end=None):
+    """
+    Writes the live partition layout, one file per timestamp under output_dirname/%Y%m%d/%H%M.
+    df is a DataFrame or the path of a Parquet/Arrow file, of which only the rows in [start, end) are read.
+
+    The frame is sorted once and sliced by index ranges; the slices are written from a thread pool, or a
+    process pool with use_processes=True. With by_day=True each task writes a whole day of files rather
+    than a single interval. Returns the number of files written.
+    """
+    if isinstance(df, (str, os.PathLike)):
+        df = read_columnar(df, start=start, end=end)
+    if df.empty:
+        return 0
+    df_sorted = df.sort_values("timestamp", kind="stable", ignore_index=True)
+    timestamps = df_sorted["timestamp"].to_numpy()
+    keys = timestamps.astype("datetime64[D]") if by_day else timestamps
+    bounds = np.concatenate(([0], np.flatnonzero(keys[1:] != keys[:-1]) + 1, [len(keys)]))
+
+    executor_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    with executor_class(max_workers=max_workers) as executor:
+        futures = [executor.submit(_write_intervals, df_sorted.iloc[begin:end], output_dirname)
+                   for begin, end in zip(bounds[:-1], bounds[1:])]
+        return sum(future.result() for future in futures)
+
+
+# Columnar formats written by write_columnar(), by file extension
+COLUMNAR_FORMATS = {"parquet": "parquet", "arrow": "ipc"}
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise ImportError("Parquet and Arrow output need pyarrow: pip install pyarrow")
+
+
+def _to_record_batch(df_chunk, dimension_values):
+    """
+    Converts a chunk to Arrow with every dimension dictionary-encoded against all of its values, so all
+    batches share the same dictionaries.
+    """
+    df_chunk = df_chunk.copy()
+    for name, values in dimension_values.items():
+        df_chunk[name] = pd.Categorical(df_chunk[name], categories=values)
+    return pa.RecordBatch.from_pandas(df_chunk, preserve_index=False)
+
+
+class ColumnarWriter:
+    """
+    Streams DataFrame chunks into one Parquet (.parquet) or Arrow IPC (.arrow) file.
+    """
+
+    def __init__(self, path, dimension_values=None, drop_columns=()):
+        _require_pyarrow()
+        self.path = path
+        self.file_format = COLUMNAR_FORMATS[os.path.splitext(path)[1][1:]]
+        self.dimension_values = dimension_values or dimensions
+        self.drop_columns = list(drop_columns)
+        self.writer = None
+        self.rows = 0
+
+    def write(self, df_chunk):
+        batch = _to_record_batch(df_chunk.drop(columns=self.drop_columns), self.dimension_values)
+        if self.writer is None:
+            if self.file_format == "parquet":
+                import pyarrow.parquet as pq
+                self.writer = pq.ParquetWriter(self.path, batch.schema)
+            else:
+                self.writer = pa.ipc.new_file(self.path, batch.schema)
+        self.writer.write_batch(batch)
+        self.rows += batch.num_rows
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+def write_columnar(chunks, path, dimension_values=None, drop_columns=()):
+    """
+    Writes chunks to one columnar file, one chunk in memory at a time.
+    :return: the number of rows written
+    """
+    writer = ColumnarWriter(path, dimension_values, drop_columns)
+    try:
+        for df_chunk in chunks:
+            writer.write(df_chunk)
+    finally:
+        writer.close()
+    return writer.rows
+
+
+def open_columnar(path):
+    """
+    Opens a file written by write_columnar() lazily, memory-mapped, without reading any data yet.
+    """
+    _require_pyarrow()
+    file_format = COLUMNAR_FORMATS[os.path.splitext(path)[1][1:]]
+    if file_format == "parquet":
+        # keep the dimension columns dictionary-encoded when they are read
+        file_format = ds.ParquetFileFormat(read_options={"dictionary_columns": list(dimensions)})
+    return ds.dataset(path, format=file_format, filesystem=pafs.LocalFileSystem(use_mmap=True))
+
+
+def _time_filter(dataset, start, end):
+    timestamp_type = dataset.schema.field("timestamp").type
+    condition = None
+    if start is not None:
+        condition = ds.field("timestamp") >= pa.scalar(pd.Timestamp(start), type=timestamp_type)
+    if end is not None:
+        before_end = ds.field("timestamp") < pa.scalar(pd.Timestamp(end), type=timestamp_type)
+        condition = before_end if condition is None else condition & before_end
+    return condition
+
+
+def iter_columnar_batches(path, columns=None, start=None, end=None, batch_size=1000000):
+    """
+    Yields the rows of a columnar file with timestamp in [start, end) as Arrow record batches, reading only
+    columns. The time filter is pushed down, so Parquet row groups outside the range are skipped.
+    """
+    dataset = open_columnar(path)
+    yield from dataset.to_batches(columns=columns, filter=_time_filter(dataset, start, end), batch_size=batch_size)
+
+
+def read_columnar(path, columns=None, start=None, end=None):
+    """
+    Reads the rows with timestamp in [start, end) of a columnar file into a DataFrame, dimensions as categoricals.
+    """
+    dataset = open_columnar(path)
+    return dataset.to_table(columns=columns, filter=_time_filter(dataset, start, end)).to_pandas()
+
+
+def write_chunks(chunks):
+    """
+    Appends every chunk to label.csv and, without the label columns, to backtest/input.csv, so only one
+    chunk is held in memory at a time.
+    """
+    label_colunn_names = [metric_name + "_label" for metric_name in metrics]
+    header = True
+    for df_chunk in chunks:
+        mode = "w" if header else "a"
+        df_chunk.to_csv("./%s/label.csv" % dataset_name, index=False, header=header, mode=mode,
+                        date_format="%Y-%m-%d %H:%M:%S")
+        df_chunk.drop(columns=label_colunn_names).to_csv("./%s/backtest/input.csv" % dataset_name, index=False,
+                                                         header=header, mode=mode,
+                                                         date_format="%Y-%m-%d %H:%M:%S")
+        header = False
+
+
+def write_columnar_chunks(chunks, file_format):
+    """
+    Like write_chunks(), to label.<file_format> and backtest/input.<file_format> ("parquet" or "arrow").
+    """
+    label_colunn_names = [metric_name + "_label" for metric_name in metrics]
+    writers = [ColumnarWriter("./%s/label.%s" % (dataset_name, file_format)),
+               ColumnarWriter("./%s/backtest/input.%s" % (dataset_name, file_format), drop_columns=label_colunn_names)]
+    try:
+        for df_chunk in chunks:
+            for writer in writers:
+                writer.write(df_chunk)
+    finally:
+        for writer in writers:
+            writer.close()
+
+
+def generate_data(vectorized=False, seed=1234, chunk_length="7D", sharded=False, max_workers=None,
+                  output_format="csv"):
+    # Data is generated and written one chunk_length window at a time so memory stays flat over the period,
+    # chunk_length=None builds the whole period at once
+    if sharded:
+        chunks = synthesize_sharded_chunks(seed, chunk_length or "30D", max_workers=max_workers)
+    elif vectorized:
+        chunks = synthesize_vectorized_chunks(seed, chunk_length)
+    else:
+        chunks = synthesize_chunks(chunk_length)
     # Get rid of old files:
     dir_path = '.'
     try:
@@ -192,7 +602,7 @@ def generate_data():
     if not os.path.exists("./data/%s/live" % dataset_name):
         os.makedirs("./%s/live" % dataset_name)
 
-    df_full.to_csv("./%s/label.csv" % dataset_name, index=False)
-    label_colunn_names = [metric_name + "_label" for metric_name in metrics]
-    df_input = df_full.drop(columns=label_colunn_names)
-    df_input.to_csv("./%s/backtest/input.csv" % dataset_name, index=False)
\ No newline at end of file
+    if output_format == "csv":
+        write_chunks(chunks)
+    else:
+        write_columnar_chunks(chunks, output_format)
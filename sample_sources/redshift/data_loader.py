@@ -1,15 +1,109 @@
 # Imports
-import botocore.session as s
 from botocore.exceptions import ClientError
+from boto3.s3.transfer import TransferConfig
+from concurrent.futures import ThreadPoolExecutor
 import json
 import boto3
+import gzip
+import math
 import os
 import base64
 import sys
 import time
 
-# Sleep so IAM and things are calmer
-time.sleep(60)
+# Reuse the statement waiter from the Lambda layer
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../ai_ops/lambdas/shared/python'))
+from actions import ResourceFailed
+from statements import wait_for_statement, backoff_delays
+from results import get_single_value
+
+# Redshift loads one file per slice at a time, so the number of parts is a multiple of the slice count, with parts
+# of at most this many uncompressed bytes
+MAX_PART_BYTES = 256 * 1024 * 1024
+PARTS_PREFIX = 'ecommerce/output/'
+MAX_WORKERS = 8
+# Multipart uploads for parts above 16MB, in 16MB chunks
+TRANSFER_CONFIG = TransferConfig(multipart_threshold=16 * 1024 * 1024, multipart_chunksize=16 * 1024 * 1024,
+                                 max_concurrency=4)
+# A freshly attached IAM role can take a moment before Redshift may use it
+MAX_COPY_ATTEMPTS = 5
+AUTHORIZATION_ERRORS = ('not authorized', 'Access Denied', 'AccessDenied')
+
+
+def get_part_ranges(path, slices):
+    """
+    Splits a file into byte ranges that end on line boundaries, as many as a multiple of slices needs to keep
+    every range below MAX_PART_BYTES.
+    :return: list of (start, end) byte offsets
+    """
+    size = os.path.getsize(path)
+    slices = max(1, slices)
+    parts = slices * max(1, math.ceil(size / (slices * MAX_PART_BYTES)))
+    boundaries = [0]
+    with open(path, 'rb') as file:
+        for i in range(1, parts):
+            file.seek(max(size * i // parts, boundaries[-1]))
+            file.readline()
+            boundaries.append(min(file.tell(), size))
+    boundaries.append(size)
+    return [(start, end) for start, end in zip(boundaries, boundaries[1:]) if end > start]
+
+
+def compress_part(path, start, end, part_path):
+    """
+    Gzips the byte range [start, end) of path into part_path.
+    """
+    with open(path, 'rb') as file, gzip.open(part_path, 'wb', compresslevel=6) as part:
+        file.seek(start)
+        remaining = end - start
+        while remaining:
+            data = file.read(min(remaining, 8 * 1024 * 1024))
+            part.write(data)
+            remaining -= len(data)
+    return part_path
+
+
+def upload_parts(path, slices):
+    """
+    Splits path into gzip parts, compressing and uploading them concurrently, and writes a COPY manifest for them.
+    :return: the S3 URL of the manifest
+    """
+    s3 = boto3.client('s3')
+    ranges = get_part_ranges(path, slices)
+    print("Splitting {} into {} parts for {} slices".format(path, len(ranges), slices))
+
+    def compress_and_upload(index):
+        start, end = ranges[index]
+        part_path = compress_part(path, start, end, "{}.{:04d}.gz".format(path, index))
+        key = PARTS_PREFIX + os.path.basename(part_path)
+        s3.upload_file(part_path, bucket, key, Config=TRANSFER_CONFIG)
+        size = os.path.getsize(part_path)
+        os.remove(part_path)
+        return {'url': 's3://' + bucket + '/' + key, 'mandatory': True, 'meta': {'content_length': size}}
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        entries = list(executor.map(compress_and_upload, range(len(ranges))))
+    manifest_key = PARTS_PREFIX + 'output.manifest'
+    s3.put_object(Bucket=bucket, Key=manifest_key, Body=json.dumps({'entries': entries}))
+    return 's3://' + bucket + '/' + manifest_key
+
+
+def run_copy(query):
+    """
+    Runs the COPY and waits for it, retrying while Redshift is not yet allowed to use the IAM role.
+    :return: the final describe_statement response
+    """
+    delays = backoff_delays(initial_delay=5, max_delay=60)
+    for attempt in range(1, MAX_COPY_ATTEMPTS + 1):
+        response = client_redshift.execute_statement(Database= db, SecretArn= secret_arn, Sql= query,
+                                                     ClusterIdentifier= cluster_id)
+        try:
+            return wait_for_statement(client_redshift, response['Id'])
+        except ResourceFailed as e:
+            if attempt == MAX_COPY_ATTEMPTS or not any(error in str(e) for error in AUTHORIZATION_ERRORS):
+                raise
+            print("COPY was not authorized yet, retrying: {}".format(e))
+            time.sleep(next(delays))
 
 
 # Obtain Secrets for DB Connection Information
@@ -52,15 +146,25 @@ iam = boto3.resource('iam')
 role = iam.Role(sys.argv[1])
 print(role.arn)
 
+# Size the parts for the slices of the cluster
+response = client_redshift.execute_statement(Database= db, SecretArn= secret_arn, Sql= "select count(*) from stv_slices;",
+                                             ClusterIdentifier= cluster_id)
+wait_for_statement(client_redshift, response['Id'])
+slices = int(get_single_value(client_redshift, response['Id']) or 0)
+if slices < 1:
+    # stv_slices only shows its rows to superusers, fall back to sizing the parts alone
+    print("Could not read the slice count from stv_slices, splitting for a single slice")
+
+manifest_url = upload_parts("output.csv", slices)
+
 # Build a query string for the copy command
 query_str = "copy ecommerce \
-from 's3://" + bucket + "/ecommerce/output.csv' \
+from '" + manifest_url + "' \
 iam_role '" + str(role.arn) +"' \
-csv; commit;"
+csv gzip manifest; commit;"
 
 print(query_str)
 
-# Execute the query
-client_redshift.execute_statement(Database= db, SecretArn= secret_arn, Sql= query_str, ClusterIdentifier= cluster_id)
-
-
+# Execute the query and wait until the rows are loaded
+desc = run_copy(query_str)
+print("COPY finished: {}".format(desc.get('ResultRows', desc['Status'])))
@@ -3,10 +3,69 @@ import botocore.session as s
 from botocore.exceptions import ClientError
 import json
 import boto3
-import time
 import base64
+import os
+import sys
+import numpy as np
 import pandas as pd
 
+# Reuse the statement waiter from the Lambda layer, and the columnar reader of the data generator
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../ai_ops/lambdas/shared/python'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../data'))
+from statements import wait_for_statement
+from results import iter_rows
+from synth_data import iter_columnar_batches
+
+# Rows per multi-row insert, and statements per batch_execute_statement call (the Data API allows 40)
+INSERT_BATCH_SIZE = 1000
+STATEMENTS_PER_BATCH = 40
+# Rows of input.csv held in memory at once
+CSV_CHUNK_SIZE = 1000000
+# Sample data written by data/synth_data.py, the columnar copies are read instead of the csv when present
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../data/ecommerce/backtest')
+COLUMNAR_INPUTS = ['input.arrow', 'input.parquet']
+
+
+def insert_dimension_values(table, values):
+    """
+    Inserts the names into a dimension table with multi-row inserts, sent in batches, and waits for them.
+    """
+    values = [str(value).replace("'", "''") for value in values]
+    inserts = ["insert into " + table + " ( name ) VALUES " + ",".join("('" + value + "')" for value in
+                                                                    values[i:i + INSERT_BATCH_SIZE]) + ";"
+               for i in range(0, len(values), INSERT_BATCH_SIZE)]
+    for i in range(0, len(inserts), STATEMENTS_PER_BATCH):
+        response = client_redshift.batch_execute_statement(Database= db, SecretArn= secret_arn,
+                                                           Sqls= inserts[i:i + STATEMENTS_PER_BATCH],
+                                                           ClusterIdentifier= cluster_id)
+        wait_for_statement(client_redshift, response['Id'])
+    print("Inserted {} values into {}".format(len(values), table))
+
+
+def map_surrogate_keys(names, ids):
+    """
+    Replaces dimension names with their integer primary keys in one pass over the column.
+    """
+    keys = names.map(ids)
+    if keys.isna().any():
+        raise ValueError("No primary key for: " + ", ".join(map(str, names[keys.isna()].unique())))
+    return keys.astype('int64')
+
+
+def map_dictionary_keys(column, ids):
+    """
+    Replaces the values of a dictionary-encoded Arrow column with their integer primary keys, looking up each
+    distinct value once.
+    """
+    names = column.dictionary.to_pylist()
+    lookup = np.array([ids.get(name, -1) for name in names], dtype='int64')
+    keys = lookup[column.indices.to_numpy(zero_copy_only=False)]
+    if (keys < 0).any():
+        missing = np.unique(column.indices.to_numpy(zero_copy_only=False)[keys < 0])
+        raise ValueError("No primary key for: " + ", ".join(sorted(names[i] for i in missing)))
+    return keys
+
+
 # Obtain Secrets for DB Connection Information
 secret_name = 'redshift-l4mintegration'  ## replace the secret name with yours
 session = boto3.session.Session()
@@ -63,43 +122,59 @@ views int,\
 revenue decimal(9,2),\
 primary key(id));\
 '
-client_redshift.execute_statement(Database= db, SecretArn= secret_arn, Sql= query_str, ClusterIdentifier= cluster_id)
-
-# Read the sample data
-data_df = pd.read_csv('/home/ec2-user/SageMaker/amazon-lookout-for-metrics-custom-connectors/data/ecommerce/backtest/input.csv')
-
-# Parse platforms into DB from the dataframe
-for platform in data_df.platform.unique():
-    print(platform)
-    query_str = "Begin;insert into platform ( name ) VALUES('" + platform + "');Commit;"
-    client_redshift.execute_statement(Database= db, SecretArn= secret_arn, Sql= query_str, ClusterIdentifier= cluster_id)
-# Parse marketplaces into DB from the dataframe
-for marketplace in data_df.marketplace.unique():
-    print(marketplace)
-    query_str = "Begin;insert into marketplace ( name ) VALUES('" + marketplace + "');Commit;"
-    client_redshift.execute_statement(Database= db, SecretArn= secret_arn, Sql= query_str, ClusterIdentifier= cluster_id)
+response = client_redshift.execute_statement(Database= db, SecretArn= secret_arn, Sql= query_str, ClusterIdentifier= cluster_id)
+wait_for_statement(client_redshift, response['Id'])
+
+# Read the distinct dimension values from the sample data, a chunk at a time
+input_csv = os.path.join(DATA_DIR, 'input.csv')
+input_columnar = next((os.path.join(DATA_DIR, name) for name in COLUMNAR_INPUTS
+                       if os.path.exists(os.path.join(DATA_DIR, name))), None)
+platform_names = set()
+marketplace_names = set()
+if input_columnar:
+    # Only the two dictionary-encoded columns are read, memory-mapped
+    for batch in iter_columnar_batches(input_columnar, columns=['platform', 'marketplace']):
+        platform_names.update(batch.column('platform').unique().to_pylist())
+        marketplace_names.update(batch.column('marketplace').unique().to_pylist())
+else:
+    for chunk in pd.read_csv(input_csv, usecols=['platform', 'marketplace'], chunksize=CSV_CHUNK_SIZE):
+        platform_names.update(chunk.platform.unique())
+        marketplace_names.update(chunk.marketplace.unique())
+
+# Parse platforms and marketplaces into DB from the dataframe
+insert_dimension_values("platform", sorted(platform_names))
+insert_dimension_values("marketplace", sorted(marketplace_names))
 
 # Next fetch the individual values from their tables so you have their ID and string value for both platforms and marketplaces
 client_redshift = session.client("redshift-data")
-query_str = "select * from platform;"
+query_str = "select id, name from platform;"
 response = client_redshift.execute_statement(Database= db, SecretArn= secret_arn, Sql= query_str, ClusterIdentifier= cluster_id)
-time.sleep(10)
-platforms = client_redshift.get_statement_result(Id=response['Id'])['Records']
-for item in platforms:
-    data_df.loc[data_df.platform == item[1]['stringValue'], "platform"] = item[0]['longValue']
-query_str = "select * from marketplace;"
+wait_for_statement(client_redshift, response['Id'])
+platform_ids = {name: id for id, name in iter_rows(client_redshift, response['Id'])}
+query_str = "select id, name from marketplace;"
 response = client_redshift.execute_statement(Database= db, SecretArn= secret_arn, Sql= query_str, ClusterIdentifier= cluster_id)
-time.sleep(10)
-marketplaces = client_redshift.get_statement_result(Id=response['Id'])['Records']
-
-# Convert the dataframe into one using the DB's primary key values
-for item in marketplaces:
-    data_df.loc[data_df.marketplace == item[1]['stringValue'], "marketplace"] = item[0]['longValue']
-
-# Reorder the columns to map to those of the database
-data_df = data_df[['timestamp', 'platform', 'marketplace', 'views', 'revenue']]
-
-# Export this file to disk so it can be used later to fill in the sample DB in Redshift.
-data_df.to_csv("output.csv", header=False, index=False)
-
-
+wait_for_statement(client_redshift, response['Id'])
+marketplace_ids = {name: id for id, name in iter_rows(client_redshift, response['Id'])}
+
+# Convert the data into the DB's primary key values chunk by chunk, and export it to disk so it can be used later
+# to fill in the sample DB in Redshift.
+header = True
+if input_columnar:
+    for batch in iter_columnar_batches(input_columnar,
+                                       columns=['timestamp', 'platform', 'marketplace', 'views', 'revenue']):
+        chunk = pd.DataFrame({'timestamp': batch.column('timestamp').to_pandas(),
+                              'platform': map_dictionary_keys(batch.column('platform'), platform_ids),
+                              'marketplace': map_dictionary_keys(batch.column('marketplace'), marketplace_ids),
+                              'views': batch.column('views').to_numpy(),
+                              'revenue': batch.column('revenue').to_numpy()})
+        chunk.to_csv("output.csv", header=False, index=False, mode="w" if header else "a",
+                     date_format="%Y-%m-%d %H:%M:%S")
+        header = False
+else:
+    for chunk in pd.read_csv(input_csv, chunksize=CSV_CHUNK_SIZE):
+        chunk['platform'] = map_surrogate_keys(chunk.platform, platform_ids)
+        chunk['marketplace'] = map_surrogate_keys(chunk.marketplace, marketplace_ids)
+        # Reorder the columns to map to those of the database
+        chunk = chunk[['timestamp', 'platform', 'marketplace', 'views', 'revenue']]
+        chunk.to_csv("output.csv", header=False, index=False, mode="w" if header else "a")
+        header = False
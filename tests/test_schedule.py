@@ -0,0 +1,76 @@
+import os
+import sys
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                'ai_ops', 'lambdas', 'shared', 'python'))
+
+from schedule import get_pending_windows, advance_watermark, get_crawl_schedule  # noqa: E402
+
+HOUR = timedelta(hours=1)
+NOW = datetime(2024, 3, 10, 12, 17)
+LATEST = datetime(2024, 3, 10, 12)
+
+
+def test_pending_windows_without_watermark_is_the_latest_interval():
+    assert get_pending_windows(None, NOW, HOUR, 8) == [(LATEST - HOUR, LATEST)]
+
+
+def test_pending_windows_after_watermark_oldest_first():
+    windows = get_pending_windows(LATEST - 3 * HOUR, NOW, HOUR, 8)
+    assert windows == [(LATEST - 3 * HOUR, LATEST - 2 * HOUR), (LATEST - 2 * HOUR, LATEST - HOUR),
+                       (LATEST - HOUR, LATEST)]
+
+
+def test_pending_windows_capped_at_max_intervals():
+    windows = get_pending_windows(LATEST - 10 * HOUR, NOW, HOUR, 2)
+    assert windows == [(LATEST - 10 * HOUR, LATEST - 9 * HOUR), (LATEST - 9 * HOUR, LATEST - 8 * HOUR)]
+
+
+def test_pending_windows_skip_present_partitions():
+    windows = get_pending_windows(LATEST - 3 * HOUR, NOW, HOUR, 8, present={LATEST - HOUR})
+    assert windows == [(LATEST - 3 * HOUR, LATEST - 2 * HOUR), (LATEST - HOUR, LATEST)]
+
+
+def test_pending_windows_backfill_missing_partitions_before_watermark():
+    present = {LATEST - 2 * HOUR, LATEST}
+    windows = get_pending_windows(LATEST, NOW, HOUR, 4, present=present, backfill=True)
+    assert windows == [(LATEST - 4 * HOUR, LATEST - 3 * HOUR), (LATEST - 2 * HOUR, LATEST - HOUR)]
+
+
+def test_pending_windows_not_due_before_interval_ends():
+    assert get_pending_windows(LATEST, NOW, HOUR, 8) == []
+
+
+def test_pending_windows_align_unaligned_watermark():
+    windows = get_pending_windows(LATEST - HOUR + timedelta(minutes=5), NOW, HOUR, 8)
+    assert windows == [(LATEST - HOUR, LATEST)]
+
+
+def test_advance_watermark_over_consecutive_exports():
+    exported = {LATEST - 2 * HOUR, LATEST - HOUR}
+    assert advance_watermark(LATEST - 3 * HOUR, exported, HOUR, LATEST) == LATEST - HOUR
+
+
+def test_advance_watermark_stops_at_gap():
+    exported = {LATEST - 2 * HOUR, LATEST}
+    assert advance_watermark(LATEST - 3 * HOUR, exported, HOUR, LATEST) == LATEST - 2 * HOUR
+
+
+def test_advance_watermark_without_exports_keeps_watermark():
+    assert advance_watermark(LATEST - 3 * HOUR, set(), HOUR, LATEST) == LATEST - 3 * HOUR
+    assert advance_watermark(None, set(), HOUR, LATEST) is None
+
+
+def test_advance_watermark_ignores_future_partitions():
+    future = datetime(2027, 5, 1, 3)
+    assert advance_watermark(None, {LATEST - HOUR, future}, HOUR, LATEST) == LATEST - HOUR
+    assert advance_watermark(None, {future}, HOUR, LATEST) is None
+    assert advance_watermark(LATEST - HOUR, {LATEST, future}, HOUR, LATEST) == LATEST
+
+
+def test_crawl_schedule_runs_once_per_interval():
+    assert get_crawl_schedule('PT5M') == 'cron(0/5 * * * ? *)'
+    assert get_crawl_schedule('PT10M') == 'cron(0/10 * * * ? *)'
+    assert get_crawl_schedule('PT1H') == 'cron(0 * * * ? *)'
+    assert get_crawl_schedule('P1D') == 'cron(0 0 * * ? *)'